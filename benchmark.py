@@ -0,0 +1,664 @@
+#!/usr/bin/env python2.7
+#
+#    Copyright (c) 2012 Morten Daugaard
+#
+#    Permission is hereby granted, free of charge, to any person obtaining a copy
+#    of this software and associated documentation files (the "Software"), to deal
+#    in the Software without restriction, including without limitation the rights
+#    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#    copies of the Software, and to permit persons to whom the Software is
+#    furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+"""
+Benchmarks for the video decoder and the receivers.
+
+Run with the name of a benchmark, eg. 'python benchmark.py startup'.
+"""
+import os
+import sys
+import time
+import random
+import pickle
+import hashlib
+import resource
+import threading
+import subprocess
+import multiprocessing
+
+import decoder
+import settings
+
+STARTUP_CASES = (
+    ('import, tables built at import (old)',
+     'import decoder; decoder.load_tables(False)'),
+    ('import, tables built lazily',
+     'import decoder'),
+    ('load tables, no cache',
+     'decoder.load_tables(False)'),
+    ('load tables, from cache',
+     'decoder.load_tables()'),
+    ('first frame, no cache',
+     'decoder.load_tables(False); decoder.read_picture_batched(frame)'),
+    ('first frame, from cache',
+     'decoder.read_picture_batched(frame)'),
+    )
+
+
+def _time_in_new_process(setup, stmt):
+    """Run setup and then stmt in a fresh interpreter, returns the seconds
+    spent in stmt."""
+    code = ("import time\n%s\nt = time.time()\n%s\nprint\nprint time.time() - t\n" %
+            (setup, stmt))
+    out = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                           cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+    return float(out.strip().splitlines()[-1])
+
+
+def bench_startup(reps=5):
+    """Startup cost of the decoder in a new process.
+
+    Compares the import when the entropy tables were built at import time
+    with the lazy import, and the cost of the first decoded frame with and
+    without the table cache.
+    """
+    reps = int(reps)
+    decoder.load_tables()   # make sure the cache exists
+
+    for name, stmt in STARTUP_CASES:
+        if stmt.startswith('import'):
+            setup = ''
+        else:
+            setup = "import decoder\nframe = open('./testdata/1.dat').read()"
+        times = [_time_in_new_process(setup, stmt) for i in xrange(reps)]
+        print '%-40s min %8.2f ms   avg %8.2f ms' % (name, min(times)*1000, sum(times)/reps*1000)
+
+
+def load_frames():
+    """Return the raw video packets in testdata/N.dat"""
+    frames = []
+    i = 1
+    while os.path.isfile('./testdata/' + str(i) + '.dat'):
+        frames.append(open('./testdata/' + str(i) + '.dat').read())
+        i += 1
+    return frames
+
+
+def load_named_frames():
+    """Return (name, packet) for the packets in testdata/N.dat, cframe.dat and
+    a pickled video capture, if there is one."""
+    frames = [(str(i + 1) + '.dat', f) for i, f in enumerate(load_frames())]
+    if os.path.isfile('./testdata/cframe.dat'):
+        frames.append(('cframe.dat', open('./testdata/cframe.dat').read()))
+    if os.path.isfile('./testdata/pickled_5555.data'):
+        capture = pickle.load(open('./testdata/pickled_5555.data'))
+        for i, (t, packet) in enumerate(capture):
+            frames.append(('pickled_5555.data:' + str(i), packet))
+    return frames
+
+
+# Decoder variants as name: (kind, function returning the image). Variants of
+# a kind decode to the same image and are checked against the same checksums.
+_frame_pool = decoder.FramePool()
+
+def _variant_reference(data):
+    return decoder.read_picture(data)[2]
+
+def _variant_batched(data):
+    return decoder.read_picture_batched(data)[2]
+
+def _variant_butterfly(data):
+    decoder.IDCT_BACKEND = 'butterfly'
+    try:
+        return decoder.read_picture_batched(data)[2]
+    finally:
+        decoder.IDCT_BACKEND = 'matrix'
+
+def _variant_into(data):
+    return decoder.read_picture_into(data, _frame_pool)[2]
+
+def _variant_luma(data):
+    return decoder.read_picture_batched(data, True)[2]
+
+def _variant_inset(data):
+    return decoder.read_picture_batched(data, False, settings.COMBO_INSET)[2]
+
+def _variant_inset_luma(data):
+    return decoder.read_picture_batched(data, True, settings.COMBO_INSET)[2]
+
+DECODER_VARIANTS = (
+    ('reference', 'rgb', _variant_reference),
+    ('batched', 'rgb', _variant_batched),
+    ('butterfly', 'rgb', _variant_butterfly),
+    ('into', 'rgb', _variant_into),
+    ('luma', 'luma', _variant_luma),
+    ('inset', 'inset', _variant_inset),
+    ('inset_luma', 'inset_luma', _variant_inset_luma),
+    )
+
+GOLDEN_CHECKSUMS = './testdata/decoder_checksums.txt'
+
+
+def image_checksum(image):
+    """md5 of the shape and pixels of a decoded image"""
+    return hashlib.md5(str(image.shape) + image.tostring()).hexdigest()
+
+
+def load_checksums():
+    """Return {(kind, frame name): checksum} from GOLDEN_CHECKSUMS"""
+    checksums = {}
+    for line in open(GOLDEN_CHECKSUMS):
+        kind, name, checksum = line.split()
+        checksums[(kind, name)] = checksum
+    return checksums
+
+
+def write_checksums():
+    """Write GOLDEN_CHECKSUMS from the first variant of every kind.
+
+    Only do this when the output of the decoder is meant to change, and
+    check the new images first.
+    """
+    frames = load_named_frames()
+    ofile = open(GOLDEN_CHECKSUMS, 'w')
+    kinds = []
+    for variant, kind, decode in DECODER_VARIANTS:
+        if kind in kinds:
+            continue
+        kinds.append(kind)
+        for name, packet in frames:
+            ofile.write('%s %s %s\n' % (kind, name, image_checksum(decode(packet))))
+    ofile.close()
+    print 'wrote', GOLDEN_CHECKSUMS
+
+
+def _run_variant(variant):
+    """Decode all test frames with variant, prints a repr of the result dict
+    on the last line. Run in a new process so the peak memory is its own."""
+    for name, kind, decode in DECODER_VARIANTS:
+        if name == variant:
+            break
+    frames = load_named_frames()
+    checksums = load_checksums()
+    decoder.load_tables()
+    decode(frames[0][1])
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    mismatches = []
+    elapsed = 0.0
+    for name, packet in frames:
+        t = time.time()
+        image = decode(packet)
+        elapsed += time.time() - t
+        if checksums.get((kind, name)) != image_checksum(image):
+            mismatches.append(name)
+
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print
+    print repr({'frames': len(frames), 'seconds': elapsed, 'mismatches': mismatches,
+                'rss_start': rss_start, 'rss_peak': rss_peak})
+
+
+DECODER_STAGES = ('entropy', 'idct', 'colour', 'copy')
+
+def _time_stages(frames, luma_only, idct):
+    """Return {stage: seconds} decoding frames stage by stage with the batched
+    decoder and the named idct backend, copy being the copy into a reused
+    frame buffer."""
+    pool = decoder.FramePool()
+    stages = dict.fromkeys(DECODER_STAGES, 0.0)
+    backend = decoder.IDCT_BACKEND
+    decoder.IDCT_BACKEND = idct
+    for name, packet in frames:
+        t0 = time.time()
+        width, height, coeffs, coded, flat = decoder.read_coefficients(packet)
+        t1 = time.time()
+        if luma_only:
+            coeffs = coeffs.reshape(-1, 6, 64)[:, 0:4].reshape(-1, 64)
+            flat = flat.reshape(-1, 6)[:, 0:4].ravel()
+        pixels = decoder.inverse_dct_fast(coeffs, flat)
+        t2 = time.time()
+        if luma_only:
+            image = decoder.luma_to_gray_batch(pixels, coded, width, height)
+        else:
+            image = decoder.ycbcr_to_rgb_batch(pixels, coded, width, height)
+        t3 = time.time()
+        out = pool.get(image.shape)
+        out[...] = image
+        t4 = time.time()
+        stages['entropy'] += t1 - t0
+        stages['idct'] += t2 - t1
+        stages['colour'] += t3 - t2
+        stages['copy'] += t4 - t3
+    decoder.IDCT_BACKEND = backend
+    return stages
+
+
+def bench_decoder(*variants):
+    """Frames per second, time per stage and peak memory of the decoder
+    variants over all test frames, and check their output against the golden
+    checksums.
+
+    Give variant names to run only those, the reference decoder takes about
+    a minute.
+    """
+    frames = load_named_frames()
+    decoder.load_tables()
+    print '%d frames' % len(frames)
+    print
+    decoder.FAST_PATH_STATS.reset()
+    for name, packet in frames:
+        decoder.read_coefficients(packet)
+    print decoder.FAST_PATH_STATS
+    print
+    for luma_only in (False, True):
+        for idct in sorted(decoder.IDCT_BACKENDS):
+            stages = _time_stages(frames, luma_only, idct)
+            print '%-6s %-10s' % ('luma' if luma_only else 'rgb', idct),
+            for stage in DECODER_STAGES:
+                print '%8s %6.2f ms' % (stage, stages[stage] / len(frames) * 1000),
+            print
+    print
+
+    failed = 0
+    for name, kind, decode in DECODER_VARIANTS:
+        if variants and name not in variants:
+            continue
+        code = 'import benchmark\nbenchmark._run_variant(%r)\n' % name
+        out = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                               cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+        res = eval(out.strip().splitlines()[-1])
+        failed += len(res['mismatches'])
+        print '%-10s %8.1f fps %8.2f ms/frame   peak %6.1f MB (+%5.1f MB)   %s' % (
+            name, res['frames'] / res['seconds'], res['seconds'] / res['frames'] * 1000,
+            res['rss_peak'] / 1024.0, (res['rss_peak'] - res['rss_start']) / 1024.0,
+            'checksums ok' if not res['mismatches'] else
+            '%d MISMATCHES eg. %s' % (len(res['mismatches']), res['mismatches'][0]))
+    return failed
+
+
+def bench_decode_pool(max_workers=None):
+    """Frames per second through a receivers.DecodePool for 1 up to
+    max_workers worker processes, with decoding in this process as baseline.
+    """
+    import receivers
+
+    frames = load_frames()
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    max_workers = int(max_workers)
+
+    decoder.load_tables()
+    t = time.time()
+    for f in frames:
+        decoder.read_picture_batched(f)
+    print '%-12s %8.1f fps' % ('in process', len(frames) / (time.time() - t))
+
+    for workers in xrange(1, max_workers + 1):
+        pool = receivers.DecodePool(workers)
+        pool.start()
+        t = time.time()
+        feeder = threading.Thread(target=lambda: [pool.submit(f, True) for f in frames])
+        feeder.start()
+        received = 0
+        while received + pool.dropped_frames + pool.failed < len(frames):
+            if pool.get(1.0) is not None:
+                received += 1
+        elapsed = time.time() - t
+        feeder.join()
+        pool.stop()
+        print '%-12s %8.1f fps   (%d dropped, %d failed)' % (str(workers) + ' workers', len(frames) / elapsed,
+                                                            pool.dropped_frames, pool.failed)
+
+
+def bench_receiver_buffers(reps=2000):
+    """Cost of publishing a packet and of reading the newest one, for the
+    receivers.SharedRing and the multiprocessing.Manager list the receivers
+    used before, with video and navdata sized packets."""
+    import receivers
+    reps = int(reps)
+
+    for name, size in (('video', 10*1024), ('navdata', 500)):
+        packet = os.urandom(size)
+
+        manager = multiprocessing.Manager()
+        comlist = manager.list([None, None, 1, settings.RUNNING])
+        t = time.time()
+        for runs in xrange(reps):
+            comlist[2] = (runs+1)%2
+            comlist[runs%2] = packet
+        put = (time.time() - t) / reps
+        t = time.time()
+        for runs in xrange(reps):
+            data = comlist[comlist[2]]
+        get = (time.time() - t) / reps
+        manager.shutdown()
+        print '%-8s manager list  put %8.1f us   get newest %8.1f us' % (name, put*1e6, get*1e6)
+
+        ring = receivers.SharedRing()
+        t = time.time()
+        for runs in xrange(reps):
+            ring.put(packet)
+        put = (time.time() - t) / reps
+        t = time.time()
+        for runs in xrange(reps):
+            seq, data = ring.get_latest()
+            ring.is_valid(seq)
+        get = (time.time() - t) / reps
+        print '%-8s shared ring   put %8.1f us   get newest %8.1f us' % (name, put*1e6, get*1e6)
+
+
+def bench_frame_cache(reps=200):
+    """Cost of a VideoReceiver frame request served from the cached frame and
+    of one that decodes, with and without frame buffers. A truncated packet
+    is checked first to raise without blocking the next request."""
+    import receivers
+    reps = int(reps)
+    frames = load_frames()
+
+    for frame_buffers in (0, 2):
+        video = receivers.VideoReceiver(frame_buffers=frame_buffers)
+        try:
+            video.on_request_data(frames[5][:len(frames[5])/2])
+        except Exception:
+            pass
+        request = threading.Thread(target=video.on_request_data, args=(frames[0],))
+        request.daemon = True
+        request.start()
+        request.join(5.0)
+        assert not request.is_alive(), 'a truncated packet blocked the next frame request'
+
+        t = time.time()
+        for i in xrange(reps):
+            video.on_request_data(frames[0])
+        hit = (time.time() - t) / reps
+        t = time.time()
+        for i in xrange(reps):
+            video.on_request_data(frames[i % 2])
+        miss = (time.time() - t) / reps
+        print '%d frame buffers   cached %8.1f us   decoded %8.1f ms' % (frame_buffers, hit*1e6,
+                                                                        miss*1e3)
+        video.sock.close()
+
+
+def bench_navdata(count=20000):
+    """Packets per second through decode_navdata, decode_navdata_lazy and the
+    byte at a time decode_navdata_bytewise, for demo and full navdata packets,
+    reading the demo option and a state bit of each. The results are compared
+    first."""
+    import testdevice
+    count = int(count)
+    rand = random.Random(1)
+    for full in (False, True):
+        packets = [testdevice.make_navdata_packet(i, full, rand) for i in xrange(1000)]
+        for packet in packets:
+            old = decoder.decode_navdata_bytewise(packet)
+            new = decoder.decode_navdata(buffer(packet))
+            assert old == new, (old, new)
+            lazy = decoder.decode_navdata_lazy(buffer(packet))
+            assert old == dict(lazy), (old, lazy)
+
+        for decode in (decoder.decode_navdata_bytewise, decoder.decode_navdata,
+                       decoder.decode_navdata_lazy):
+            t = time.time()
+            for i in xrange(count):
+                nd = decode(packets[i % 1000])
+                nd[0]['psi']
+                nd['drone_state']['emergency_mask']
+            elapsed = time.time() - t
+            print '%-5s %-24s %10.0f packets/s %8.1f us/packet' % ('full' if full else 'demo', decode.__name__,
+                                                                   count / elapsed, elapsed / count * 1e6)
+
+
+def bench_load(scale=1.0, jitter=0.0, reorder=0.0, duplicate=0.0, loss=0.0, duration=5.0):
+    """Drop rates and latency of the receivers under a testdevice load
+    generator sending scale times the drone's rates of 15 video frames, 200
+    full navdata packets and 10 wifi samples a second, with the given link
+    impairments."""
+    import testdevice
+    rates = {settings.VIDEO_PORT: 15.0*float(scale), settings.NAVDATA_PORT: 200.0*float(scale),
+             settings.WIFI_PORT: 10.0*float(scale)}
+    return testdevice.run_load(rates=rates, duration=float(duration), navdata_full=True,
+                               jitter=float(jitter), reorder=float(reorder),
+                               duplicate=float(duplicate), loss=float(loss))
+
+
+# upper bounds of the latency histogram buckets, in ms
+HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, float('inf'))
+
+
+def print_latency_report(stages):
+    """Print percentiles and a histogram of the (name, seconds) stages."""
+    import numpy as np
+    print '%-10s %6s %8s %8s %8s %8s %8s' % ('stage', 'n', 'mean ms', 'p50', 'p90', 'p99', 'max')
+    for name, values in stages:
+        ms = np.array(values or [np.nan])*1000
+        print '%-10s %6d %8.2f %8.2f %8.2f %8.2f %8.2f' % ((name, len(values), ms.mean()) +
+                                                         tuple(np.percentile(ms, [50, 90, 99, 100])))
+    for name, values in stages:
+        if not values:
+            continue
+        counts = np.histogram(np.array(values)*1000, (0,) + HISTOGRAM_BUCKETS)[0]
+        print
+        print name
+        low = 0
+        for high, count in zip(HISTOGRAM_BUCKETS, counts):
+            print '  %5s-%-5s ms %6d %s' % (low, high, count, '#'*int(round(40.0*count/max(counts))))
+            low = high
+
+
+def bench_pipeline(duration=20.0, mode='normal'):
+    """Latency of the whole loop of a headless test drone, from a video packet
+    leaving the TestDevice to the first PCMD command sent after the frame was
+    decoded, looked at by the PositionDetector in mode and acted on by an
+    AvoidTask, which the benchmark catches on the command port.
+
+    The stages are timed by wrapping the methods of the drone, and the
+    receive stage by the time the video receiver published the packet.
+    """
+    import bisect
+    import socket
+    import drone
+    import newesttasks
+    import testdevice
+    import virtualsensors
+
+    settings.TEST_SEND_AT = True
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind((settings.TEST_DRONE_IP, settings.CMD_PORT))
+    sink.settimeout(0.2)
+    arrivals = []
+    stopping = []
+    def listen():
+        while not stopping:
+            try:
+                data, addr = sink.recvfrom(65535)
+            except socket.timeout:
+                continue
+            if 'AT*PCMD' in data:
+                arrivals.append(time.time())
+    listener = threading.Thread(target=listen)
+    listener.start()
+
+    d = drone.Drone(True, headless=True)
+
+    # number the video packets at the end, where the decoder ignores it
+    sends = []
+    tag = testdevice.LoadGenerator.TAG
+    class NumberingSocket(object):
+        def __init__(self, sock):
+            self.sock = sock
+        def sendto(self, data, address):
+            sends.append(time.time())
+            return self.sock.sendto(str(data) + tag.pack(len(sends) - 1), address)
+    d.testdevice.video_send_sock = NumberingSocket(d.testdevice.video_send_sock)
+
+    frames = []
+    fetched = []
+    video = d.get_video_sensor()
+    get_data = video.get_data
+    def timed_get_data(*args):
+        seq, data = video.ring.get_latest()
+        number = put = None
+        if data is not None:
+            number = testdevice.LoadGenerator.get_tag(settings.VIDEO_PORT, data)
+            put = video.ring.get_time(seq)
+        start = time.time()
+        result = get_data(*args)
+        fetched[:] = [dict(number=number, put=put, start=start, decoded=time.time())]
+        return result
+    video.get_data = timed_get_data
+
+    detect_once = virtualsensors.PositionDetector.detect_once
+    def timed_detect_once(self):
+        detect_once(self)
+        if fetched and fetched[0]['number'] is not None:
+            frame = fetched.pop()
+            frame['detected'] = time.time()
+            frames.append(frame)
+
+    moves = []
+    move_once = newesttasks.TaskManager.move_once
+    def timed_move_once(self):
+        start = time.time()
+        move_once(self)
+        moves.append((start, time.time()))
+
+    # every watchdog tick sends a PCMD in its batch of commands
+    commands = []
+    send_batch = d.interface.send_batch
+    def timed_send_batch():
+        start = time.time()
+        send_batch()
+        commands.append((start, time.time()))
+    d.interface.send_batch = timed_send_batch
+
+    virtualsensors.PositionDetector.detect_once = timed_detect_once
+    newesttasks.TaskManager.move_once = timed_move_once
+    try:
+        d.start()
+        d.position_detector.mode = mode
+        d.task_manager.start_task(newesttasks.AvoidTask(d, d.task_manager.task_done, None))
+        # the watchdog sends every 0.02s while flying
+        d.interface.take_off()
+        time.sleep(float(duration))
+        d.stop()
+    finally:
+        virtualsensors.PositionDetector.detect_once = detect_once
+        newesttasks.TaskManager.move_once = move_once
+        stopping.append(1)
+        listener.join()
+        sink.close()
+
+    stages = dict((name, []) for name in ('receive', 'wait', 'decode', 'detect', 'domove', 'at send',
+                                          'end to end'))
+    move_starts = [m[0] for m in moves]
+    command_starts = [c[0] for c in commands]
+    for f in frames:
+        if f['put'] is None or f['number'] >= len(sends):
+            continue
+        sent = sends[f['number']]
+        stages['receive'].append(f['put'] - sent)
+        stages['wait'].append(f['start'] - f['put'])
+        stages['decode'].append(f['decoded'] - f['start'])
+        stages['detect'].append(f['detected'] - f['decoded'])
+        # the first task move after the detection, the first PCMD after that
+        # and when it arrived
+        i = bisect.bisect_left(move_starts, f['detected'])
+        if i == len(moves):
+            continue
+        stages['domove'].append(moves[i][1] - f['detected'])
+        j = bisect.bisect_left(command_starts, moves[i][1])
+        if j == len(commands):
+            continue
+        stages['at send'].append(commands[j][1] - moves[i][1])
+        k = bisect.bisect_left(arrivals, commands[j][0])
+        if k < len(arrivals):
+            stages['end to end'].append(arrivals[k] - sent)
+
+    print
+    print len(sends), 'video packets sent,', len(frames), 'frames detected on,', len(moves), \
+        'task moves,', len(commands), 'PCMD commands sent'
+    print_latency_report([(name, stages[name]) for name in ('receive', 'wait', 'decode', 'detect',
+                                                           'domove', 'at send', 'end to end')])
+    return stages
+
+
+def bench_at_encoder(count=100000):
+    """Commands per second encoded by the controllers at_ functions and by the
+    generic controllers.at they used before, for each command and for the
+    watchdog tick of COMWDG, REF and PCMD. The messages are compared first."""
+    import controllers
+    count = int(count)
+    rand = random.Random(1)
+    # movements as the controllers and tasks make them, mostly repeated
+    moves = [(0.0, 0.0, 0.0, 0.0), (0, 0, 0, -0.2), (0.3, 0.0, 0.0, 0.0)]
+    moves += [tuple(round(rand.uniform(-1, 1), 2) for i in range(4)) for j in range(5)]
+
+    def old_ref(seq, takeoff):
+        return controllers.at("REF", seq, [0b10001010101000000000000000000 + (0b1000000000 if takeoff else 0)])
+
+    def old_pcmd(seq, progressive, lr, fb, vv, va):
+        return controllers.at("PCMD", seq, [1 if progressive else 0, float(lr), float(fb), float(vv), float(va)])
+
+    def old_tick(seq, move):
+        return (controllers.at("COMWDG", seq, []) + old_ref(seq+1, True) +
+                old_pcmd(seq+2, True, *move))
+
+    def new_tick(seq, move):
+        return (controllers.at_comwdg(seq) + controllers.at_ref(seq+1, True) +
+                controllers.at_pcmd(seq+2, True, *move))
+
+    cases = (
+        ('REF', lambda i: old_ref(i, i & 1), lambda i: controllers.at_ref(i, i & 1)),
+        ('PCMD', lambda i: old_pcmd(i, True, *moves[i % len(moves)]),
+         lambda i: controllers.at_pcmd(i, True, *moves[i % len(moves)])),
+        ('LED', lambda i: controllers.at("LED", i, [1, 1.0, 2]), lambda i: controllers.at_led(i, 1, 1.0, 2)),
+        ('COMWDG', lambda i: controllers.at("COMWDG", i, []), controllers.at_comwdg),
+        ('FTRIM', lambda i: controllers.at("FTRIM", i, []), controllers.at_ftrim),
+        ('ZAP', lambda i: controllers.at("ZAP", i, [i & 3]), lambda i: controllers.at_zap(i, i & 3)),
+        ('CONFIG', lambda i: controllers.at("CONFIG", i, ["video:video_channel", str(i & 3)]),
+         lambda i: controllers.at_config(i, "video:video_channel", i & 3)),
+        ('tick', lambda i: old_tick(i, moves[i % len(moves)]), lambda i: new_tick(i, moves[i % len(moves)])),
+        )
+    for name, old, new in cases:
+        for i in xrange(1000):
+            assert old(i) == new(i), (old(i), new(i))
+        rates = []
+        for encode in (old, new):
+            t = time.time()
+            for i in xrange(count):
+                encode(i)
+            rates.append(count / (time.time() - t))
+        print '%-7s at %10.0f commands/s   at_ %10.0f commands/s   %5.1fx' % (name, rates[0], rates[1],
+                                                                            rates[1] / rates[0])
+
+
+BENCHMARKS = {
+    'decoder': bench_decoder,
+    'golden': write_checksums,
+    'navdata': bench_navdata,
+    'startup': bench_startup,
+    'decodepool': bench_decode_pool,
+    'buffers': bench_receiver_buffers,
+    'framecache': bench_frame_cache,
+    'load': bench_load,
+    'pipeline': bench_pipeline,
+    'atencode': bench_at_encoder,
+    }
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print 'usage: benchmark.py', '|'.join(sorted(BENCHMARKS))
+    else:
+        BENCHMARKS[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,283 @@
+#!/usr/bin/env python2.7
+#    Copyright (c) 2012 Morten Daugaard
+#
+#    Permission is hereby granted, free of charge, to any person obtaining a copy
+#    of this software and associated documentation files (the "Software"), to deal
+#    in the Software without restriction, including without limitation the rights
+#    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#    copies of the Software, and to permit persons to whom the Software is
+#    furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+""" The capturelog module writes captured packets to an append-only binary log,
+and reads them back with CaptureLog.
+
+A log starts with FILE_HEADER and is a run of records, each a RECORD header
+followed by its payload:
+
+type      -- DATA for a captured packet, INDEX for an index
+port      -- the port the packet came in on
+length    -- the length of the payload
+seq       -- the number of the packet at its receiver, for an index the
+             offset of the previous index or -1
+timestamp -- time.time() when the packet was received
+
+Every index_every packets an index is written, its payload is an INDEX_ENTRY
+(offset, timestamp, seq, port) per packet since the previous index, followed
+by INDEX_END holding the offset of the index itself. The last index of a
+closed log is at the end of the file, so the whole log can be indexed by
+following the indexes back from there. A log cut short by a crash is read
+up to its last whole record.
+"""
+
+import os
+import mmap
+import time
+import pickle
+import struct
+
+import numpy as np
+
+import settings
+
+FILE_HEADER = struct.Struct('<8sI')         # magic, version
+RECORD = struct.Struct('<cxHIqd')           # type, port, length, seq, timestamp
+INDEX_ENTRY = struct.Struct('<qdqH6x')      # offset, timestamp, seq, port
+INDEX_END = struct.Struct('<q8s')           # offset of the index, magic
+
+MAGIC = 'ARCAPLOG'
+END_MAGIC = 'ARCAPEND'
+VERSION = 1
+
+DATA = 'D'
+INDEX = 'I'
+
+
+class CaptureWriter(object):
+    """Writes packets to a capture log as they come.
+
+    The file is opened on the first packet, so a writer can be made for every
+    run of a receiver whether it captures or not. Only the index entries
+    since the last index are kept in memory, and the file is flushed with
+    every index and at least every flush_interval seconds, so a long capture
+    takes no more memory than a short one and a crash loses at most the
+    packets of the last flush_interval seconds.
+    """
+
+    def __init__(self, path, index_every=256, flush_interval=1.0):
+        self.path = path
+        self.index_every = index_every
+        self.flush_interval = flush_interval
+        self.file = None
+        self.offset = 0
+        self.last_index = -1
+        self.entries = []
+        self.last_flush = 0
+        self.count = 0
+
+    def open(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.offset = FILE_HEADER.size
+        self.last_flush = time.time()
+
+    def write(self, port, seq, data, timestamp=None):
+        """Append a packet to the log."""
+        if self.file is None:
+            self.open()
+        if timestamp is None:
+            timestamp = time.time()
+        self.file.write(RECORD.pack(DATA, port, len(data), seq, timestamp))
+        self.file.write(data)
+        self.entries.append((self.offset, timestamp, seq, port))
+        self.offset += RECORD.size + len(data)
+        self.count += 1
+
+        if len(self.entries) >= self.index_every:
+            self.write_index()
+        elif timestamp - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_index(self):
+        """Write an index of the packets since the previous one and flush."""
+        length = len(self.entries)*INDEX_ENTRY.size + INDEX_END.size
+        self.file.write(RECORD.pack(INDEX, 0, length, self.last_index, time.time()))
+        for entry in self.entries:
+            self.file.write(INDEX_ENTRY.pack(*entry))
+        self.file.write(INDEX_END.pack(self.offset, END_MAGIC))
+        self.last_index = self.offset
+        self.offset += RECORD.size + length
+        self.entries = []
+        self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        """Write the last index and close the log, returns the number of
+        packets written."""
+        if self.file is not None:
+            if self.entries or self.last_index < 0:
+                self.write_index()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+        return self.count
+
+
+def read_records(path):
+    """Yield the (timestamp, port, seq, data) of every packet in a capture log
+    in the order they were written, up to the last whole record."""
+    f = open(path, 'rb')
+    try:
+        magic, version = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not a capture log' % path)
+        while 1:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            kind, port, length, seq, timestamp = RECORD.unpack(header)
+            if kind == INDEX:
+                f.seek(length, os.SEEK_CUR)
+                continue
+            data = f.read(length)
+            if len(data) < length:
+                break
+            yield timestamp, port, seq, data
+    finally:
+        f.close()
+
+
+# INDEX_ENTRY as a numpy record, to read indexes straight from the file
+INDEX_DTYPE = np.dtype([('offset', '<i8'), ('timestamp', '<f8'), ('seq', '<i8'), ('port', '<u2'),
+                        ('pad', 'V6')])
+
+
+class CaptureLog(object):
+    """Random access to the packets of a capture log, memory mapped.
+
+    Opening a closed log reads only its indexes, following them back from
+    the end of the file, so it takes no time and little memory however long
+    the log is. A log that was not closed is indexed by reading the record
+    headers from the start. Packets are returned as buffers into the mapped
+    file, which the operating system pages in as they are read.
+
+    With port, only the packets of that port are in the log.
+    """
+
+    def __init__(self, path, port=None):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mem = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = FILE_HEADER.unpack_from(self.mem, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a capture log' % path)
+
+        index = self.read_indexes()
+        if index is None:
+            index = self.scan()
+        if port is not None:
+            index = index[index['port'] == port]
+        self.index = index
+        self.timestamps = index['timestamp']
+
+    def read_indexes(self):
+        """Return the index of a closed log, or None if it was not closed."""
+        if len(self.mem) < FILE_HEADER.size + RECORD.size + INDEX_END.size:
+            return None
+        offset, magic = INDEX_END.unpack_from(self.mem, len(self.mem) - INDEX_END.size)
+        if magic != END_MAGIC:
+            return None
+        parts = []
+        while offset >= 0:
+            kind, port, length, previous, timestamp = RECORD.unpack_from(self.mem, offset)
+            assert kind == INDEX, 'broken index in %s' % self.path
+            count = (length - INDEX_END.size)/INDEX_ENTRY.size
+            parts.append(np.frombuffer(self.mem, INDEX_DTYPE, count, offset + RECORD.size))
+            offset = previous
+        parts.reverse()
+        return np.concatenate(parts) if parts else np.zeros(0, INDEX_DTYPE)
+
+    def scan(self):
+        """Index the log from its record headers, up to the last whole
+        record."""
+        entries = []
+        offset = FILE_HEADER.size
+        end = len(self.mem)
+        while offset + RECORD.size <= end:
+            kind, port, length, seq, timestamp = RECORD.unpack_from(self.mem, offset)
+            if offset + RECORD.size + length > end:
+                break
+            if kind == DATA:
+                entries.append((offset, timestamp, seq, port, ''))
+            offset += RECORD.size + length
+        return np.array(entries, INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        """Return the (timestamp, port, seq, data) of packet i."""
+        entry = self.index[i]
+        return entry['timestamp'], int(entry['port']), int(entry['seq']), self.packet(i)
+
+    def packet(self, i):
+        """Return the data of packet i as a buffer into the log."""
+        offset = int(self.index['offset'][i])
+        length = RECORD.unpack_from(self.mem, offset)[2]
+        return buffer(self.mem, offset + RECORD.size, length)
+
+    def timestamp(self, i):
+        return self.timestamps[i]
+
+    def find(self, timestamp):
+        """Return the number of the first packet received at or after
+        timestamp."""
+        return int(np.searchsorted(self.timestamps, timestamp, 'left'))
+
+    def close(self):
+        self.mem.close()
+        self.file.close()
+
+
+def write_log(path, packets, port):
+    """Write (timestamp, data) packets to a new capture log."""
+    writer = CaptureWriter(path)
+    for seq, (timestamp, data) in enumerate(packets):
+        writer.write(port, seq, data, timestamp)
+    return writer.close()
+
+
+def convert_pickled(pickled, path, port):
+    """Write a capture pickled by older receivers, a list of (datetime, data),
+    to a capture log."""
+    packets = pickle.load(open(pickled, 'rb'))
+    return write_log(path, ((time.mktime(t.timetuple()) + t.microsecond/1e6, data)
+                            for t, data in packets), port)
+
+
+def convert_frames(names, path, port, rate=15.0):
+    """Write the video packets in the files names to a capture log, rate per
+    second."""
+    return write_log(path, ((i/rate, open(name, 'rb').read()) for i, name in enumerate(names)),
+                     port)
+
+
+if __name__ == '__main__':
+    # Convert the captures in ./testdata to capture logs for the TestDevice
+    for port in (settings.VIDEO_PORT, settings.WIFI_PORT, settings.NAVDATA_PORT):
+        pickled = './testdata/pickled_' + str(port) + '.data'
+        if os.path.isfile(pickled):
+            print pickled, convert_pickled(pickled, './testdata/capture_' + str(port) + '.log', port)
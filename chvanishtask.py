@@ -49,7 +49,7 @@ if __name__ == "__main__":
         y_tilt = ndd.get('phi',0)
         print "y_tilt", y_tilt
             #img_a = video_sensor.get_data()
-        img_a = cv2.cvtColor( video_sensor.get_data() , cv2.COLOR_BGR2GRAY)
+        img_a = video_sensor.get_data(True)
         point, ppty = cs.findCorridorVanishPoint(img_a, y_tilt, True)
             #print point
         if cv.WaitKey(3) == 27:
@@ -35,6 +35,7 @@ import cv2
 
 import utils
 import tasks
+import eventloop
 import settings
 import matcher
 import drone as drone_module
@@ -42,15 +43,17 @@ import drone as drone_module
 class ControllerManager(object):
 
 
-    def __init__(self, drone):
+    def __init__(self, drone, inputs=True):
         self.drone = drone
-        #auto = AutoControl(self.drone)
-        man = JoystickControl(self.drone)
-        key = KeyboardControl(self.drone)
         self.controllers = []
-        self.controllers.append(key)
-        self.controllers.append(man)
-        #self.controllers.append(auto)
+        # without inputs the drone runs headless, without keyboard and joystick
+        if inputs:
+            #auto = AutoControl(self.drone)
+            man = JoystickControl(self.drone)
+            key = KeyboardControl(self.drone)
+            self.controllers.append(key)
+            self.controllers.append(man)
+            #self.controllers.append(auto)
 
     def get_controllers(self):
         return self.controllers
@@ -383,8 +386,10 @@ class JoystickControl(Controller):
 
 
 class ControllerInterface(threading.Thread):
-    def __init__(self):
+    def __init__(self, loop=None):
         threading.Thread.__init__(self)
+        # with a SensorLoop the watchdog runs on it instead of in this thread
+        self.loop = loop
         self.lock = threading.Lock()
         self.zaplock = threading.Lock()
         self.seq_num = 1
@@ -400,24 +405,78 @@ class ControllerInterface(threading.Thread):
         self.gaz = 0.0
         self.auto = False
 
-        if settings.TEST:
+        if settings.TEST and not settings.TEST_SEND_AT:
             self.at = self.__at_test
         else:
             self.at = self.__at_live
 
-        self.at(at_config, "general:navdata_demo", "TRUE")
-        #self.at(at_config, "general:navdata_demo", "FALSE")
+        # One socket sends all commands. While batching, as in every
+        # watchdog tick, commands are collected and sent in one datagram.
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if settings.TEST:
+            self.address = (settings.TEST_DRONE_IP, settings.CMD_PORT)
+        else:
+            self.address = (settings.DRONE_IP, settings.CMD_PORT)
+        self.batching = False
+        self.pending = []
+        self.pending_size = 0
+
+        if settings.NAVDATA_FULL:
+            self.at(at_config, "general:navdata_demo", "FALSE")
+        else:
+            self.at(at_config, "general:navdata_demo", "TRUE")
         #self.at(at_config,"control:flying_mode","1")
         #self.at(at_config,"detect:detect_type","10")
         #self.at(at_config,"detect:detections_select_v","4")
         #self.at(at_config, "general:navdata_options","1024")
 
+    def start(self):
+        if self.loop is None:
+            threading.Thread.start(self)
+        else:
+            self.loop.spawn(self.watchdog())
+
     def run(self):
+        eventloop.run_blocking(self.watchdog())
+
+    def watchdog(self):
+        """Send the watchdog and the current movement every sleep_time
+        seconds, as a coroutine."""
         while not self.stopping:
-            self.__commwdg()
-            # print 'vals:', self.roll, self.pitch, self.gaz, self.yaw, self.auto
-            self.__update(self.roll, self.pitch, self.gaz, self.yaw, self.auto)
-            time.sleep(self.sleep_time)
+            self.begin_batch()
+            try:
+                self.__commwdg()
+                # print 'vals:', self.roll, self.pitch, self.gaz, self.yaw, self.auto
+                self.__update(self.roll, self.pitch, self.gaz, self.yaw, self.auto)
+            finally:
+                self.send_batch()
+            yield self.sleep_time
+
+        # stop has landed by now, commands from here on are not sent
+        self.lock.acquire()
+        self.sock.close()
+        self.sock = None
+        self.lock.release()
+
+    def begin_batch(self):
+        """Collect the commands from now on, until send_batch."""
+        self.lock.acquire()
+        self.batching = True
+        self.lock.release()
+
+    def send_batch(self):
+        """Send the collected commands in one datagram."""
+        self.lock.acquire()
+        self.batching = False
+        self.__flush()
+        self.lock.release()
+
+    def __flush(self):
+        if self.pending:
+            if self.sock is not None:
+                self.sock.sendto(''.join(self.pending), self.address)
+            self.pending = []
+            self.pending_size = 0
     
     def stop(self):
         self.land()
@@ -542,8 +601,15 @@ class ControllerInterface(threading.Thread):
         """
         self.lock.acquire()
         #self.com_watchdog_timer.cancel()
-        cmd(self.seq_num, *args, **kwargs)
+        msg = cmd(self.seq_num, *args, **kwargs)
         self.seq_num += 1
+        # the drone reads at most AT_PACKET_SIZE bytes of a datagram
+        if self.pending_size + len(msg) > settings.AT_PACKET_SIZE:
+            self.__flush()
+        self.pending.append(msg)
+        self.pending_size += len(msg)
+        if not self.batching:
+            self.__flush()
         #self.com_watchdog_timer = threading.Timer(self.timer_t, self.commwdg)
         #self.com_watchdog_timer.start()
         self.lock.release()
@@ -556,6 +622,33 @@ class ControllerInterface(threading.Thread):
 # Low level functions
 #=====================================================================================
 
+# Each command has its message format compiled once, and float parameters are
+# converted to their int32 bits together with one precompiled Struct instead
+# of a struct.pack and struct.unpack per float, as at() does.
+REF_FORMAT = 'AT*REF=%d,%d\r'
+PCMD_FORMAT = 'AT*PCMD=%d,%d,%d,%d,%d,%d\r'
+LED_FORMAT = 'AT*LED=%d,%d,%d,%d\r'
+COMWDG_FORMAT = 'AT*COMWDG=%d\r'
+FTRIM_FORMAT = 'AT*FTRIM=%d\r'
+ZAP_FORMAT = 'AT*ZAP=%d,%d\r'
+CONFIG_FORMAT = 'AT*CONFIG=%d,"%s","%s"\r'
+
+FLOAT = struct.Struct('<f')
+INT = struct.Struct('<i')
+PCMD_FLOATS = struct.Struct('<4f')
+PCMD_INTS = struct.Struct('<4i')
+
+# The int32 bits of recent (lr, fb, vv, va) of at_pcmd. The watchdog sends the
+# same movement every tick until it changes, so nearly all are found here.
+# -0.0 == 0.0 finds the entry of the other, so the values are normalised with
+# + 0.0 and -0.0 is always sent as 0.0, the same to the drone.
+pcmd_cache = {}
+PCMD_CACHE_SIZE = 1024
+
+REF_BASE = 0b10001010101000000000000000000
+REF_TAKEOFF = 0b1000000000
+REF_EMERGENCY = 0b0100000000
+
 def at_ref(seq, takeoff, emergency=False):
     """
     Basic behaviour of the drone: take-off/landing, emergency stop/reset)
@@ -565,12 +658,12 @@ def at_ref(seq, takeoff, emergency=False):
     takeoff -- True: Takeoff / False: Land
     emergency -- True: Turn of the engines
     """
-    p = 0b10001010101000000000000000000
+    p = REF_BASE
     if takeoff:
-        p += 0b1000000000
+        p += REF_TAKEOFF
     if emergency:
-        p += 0b0100000000
-    at("REF", seq, [p])
+        p += REF_EMERGENCY
+    return REF_FORMAT % (seq, p)
         
 def at_pcmd(seq, progressive, lr, fb, vv, va):
     """
@@ -589,9 +682,14 @@ def at_pcmd(seq, progressive, lr, fb, vv, va):
 
     The above float values are a percentage of the maximum speed.
     """
-    
-    p = 1 if progressive else 0
-    at("PCMD", seq, [p, float(lr), float(fb), float(vv), float(va)])
+    key = (lr + 0.0, fb + 0.0, vv + 0.0, va + 0.0)
+    ints = pcmd_cache.get(key)
+    if ints is None:
+        ints = PCMD_INTS.unpack(PCMD_FLOATS.pack(*key))
+        if len(pcmd_cache) >= PCMD_CACHE_SIZE:
+            pcmd_cache.clear()
+        pcmd_cache[key] = ints
+    return PCMD_FORMAT % (seq, 1 if progressive else 0, ints[0], ints[1], ints[2], ints[3])
     
 
 def at_led(seq, anim, f, d):
@@ -604,14 +702,14 @@ def at_led(seq, anim, f, d):
     f -- ?: frequence in HZ of the animation
     d -- Integer: total duration in seconds of the animation
     """
-    at("LED", seq, [anim, float(f), d])
+    return LED_FORMAT % (seq, anim, f2i(f), d)
 
 def at_comwdg(seq):
     """
     Reset communication watchdog.
     """
     # FIXME: no sequence number
-    at("COMWDG", seq, [])
+    return COMWDG_FORMAT % seq
 
 def at_ftrim(seq):
     """
@@ -620,7 +718,7 @@ def at_ftrim(seq):
     Parameters:
     seq -- sequence number
     """
-    at("FTRIM", seq, [])
+    return FTRIM_FORMAT % seq
 
 def at_zap(seq, stream):
     """
@@ -631,15 +729,20 @@ def at_zap(seq, stream):
     stream -- Integer: video stream to broadcast
     """
     # FIXME: improve parameters to select the modes directly
-    at("ZAP", seq, [stream])
+    return ZAP_FORMAT % (seq, stream)
 
 def at_config(seq, option, value):
     """Set configuration parameters of the drone."""
-    at("CONFIG", seq, [str(option), str(value)])
+    return CONFIG_FORMAT % (seq, option, value)
 
 
 def at(command, seq, params):
     """
+    Returns the AT command message, for the ControllerInterface to send.
+
+    The at_ functions format their commands directly, this is for any other
+    command.
+
     Parameters:
     command -- the command
     seq -- the sequence number
@@ -654,14 +757,11 @@ def at(command, seq, params):
         elif type(p) == str:
             param_str += ',"'+p+'"'
             
-    msg = "AT*%s=%i%s\r" % (command, seq, param_str)
-    
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.sendto(msg, (settings.DRONE_IP, settings.CMD_PORT))
+    return "AT*%s=%i%s\r" % (command, seq, param_str)
                 
 def f2i(f):
     #Interpret IEEE-754 floating-point value as signed integer.
-    return struct.unpack('i', struct.pack('f', f))[0]
+    return INT.unpack(FLOAT.pack(f))[0]
 
 
 #======================================================================================
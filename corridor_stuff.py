@@ -30,8 +30,12 @@ def findCorridorVanishPoint(img_a, y_tilt, from_main=False):
     #gray = cv.fromarray(img_a)
     #gray = img_a
 
-    #if 2 < len(img_a.shape) and img_a.shape[2] < 1:
-    gray = cv2.cvtColor(img_a, cv2.COLOR_BGR2GRAY)
+    # frames from a luma only video receiver are grey already, copy as the
+    # canny below works in place
+    if len(img_a.shape) == 2:
+        gray = img_a.copy()
+    else:
+        gray = cv2.cvtColor(img_a, cv2.COLOR_BGR2GRAY)
     #dst = cv.CreateMat(h, w, cv.CV_8UC1) #cv2.cv.cvmat
     gray = cv.fromarray( gray )
     #dst = cv2.Canny( gray, 50, 200, 3 )
@@ -50,16 +50,19 @@ in a way that it works also without psyco installed. On the author's
 development machine the speed up is from 2FPS w/o psyco to > 20 FPS w/ psyco.
 """
 import array
+import collections
 #import cProfile
 import datetime
+import mmap
+import os
 import struct
 import sys
+import time
 try:
     import numpypy
 except ImportError:
     print 'Not using pypy'
 import numpy as np
-import cv2.cv as cv
 
 try:
     import psyco
@@ -76,6 +79,7 @@ class BitReader(object):
         self.bits_left = 0
         self.chunk = 0
         self.read_bits = 0
+        self.flat_blocks = 0
 
     # def derp(self, nbits, consume=True):
     #     """derp nbits and return the integervalue of the read bits.
@@ -129,6 +133,116 @@ class BitReader(object):
         self.read(shift)
 
 
+class WordReader(object):
+    """Bitreader working on the whole packet at once.
+
+    The packet is unpacked into a tuple of 32 bit words up front, so reading
+    is just indexing and shifting. The stream is the same as for BitReader. The
+    decoder reads words and pos directly, lookups and symbols are counted by
+    the multi symbol decoding in get_block_coeffs, which also lists the blocks
+    without AC coefficients in flat_blocks.
+    """
+
+    def __init__(self, packet):
+        # two extra zero words, so a read never runs off the end
+        n = (len(packet) + 3) / 4 + 2
+        self.words = struct.unpack('<%dI' % n, packet + '\x00' * (4*n - len(packet)))
+        self.pos = 0
+        self.lookups = 0
+        self.symbols = 0
+        self.flat_blocks = []
+
+    def read(self, nbits, consume=True):
+        """Read nbits (at most 32) and return the integervalue of the read bits.
+
+        If consume is False, it behaves like a 'peek' method.
+        """
+        w = self.pos >> 5
+        chunk = self.words[w] << 32 | self.words[w + 1]
+        res = (chunk >> (64 - (self.pos & 31) - nbits)) & ((1 << nbits) - 1)
+        if consume:
+            self.pos += nbits
+        return res
+
+    def align(self):
+        """Byte align the data stream."""
+        self.pos += (8 - self.pos) % 8
+
+
+class EntropyStats(object):
+    """Counters for the entropy decoding done by read_coefficients."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.bytes = 0
+        self.lookups = 0
+        self.symbols = 0
+        self.seconds = 0.0
+
+    def add(self, reader, nbytes, seconds):
+        self.frames += 1
+        self.bytes += nbytes
+        self.lookups += reader.lookups
+        self.symbols += reader.symbols
+        self.seconds += seconds
+
+    def symbols_per_lookup(self):
+        if not self.lookups:
+            return 0.0
+        return self.symbols / float(self.lookups)
+
+    def bytes_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.bytes / self.seconds
+
+    def __str__(self):
+        return ("%d frames, %d bytes, %.2f symbols per lookup, %.0f bytes/s" %
+                (self.frames, self.bytes, self.symbols_per_lookup(), self.bytes_per_second()))
+
+ENTROPY_STATS = EntropyStats()
+
+
+class FastPathStats(object):
+    """Share of the blocks per frame that had no AC coefficients, and so
+    skipped the idct."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.blocks = 0
+        self.flat_blocks = 0
+        self.last = 0.0
+        self.lowest = 1.0
+        self.highest = 0.0
+
+    def add(self, blocks, flat_blocks):
+        self.frames += 1
+        self.blocks += blocks
+        self.flat_blocks += flat_blocks
+        self.last = flat_blocks / float(blocks)
+        self.lowest = min(self.lowest, self.last)
+        self.highest = max(self.highest, self.last)
+
+    def fraction(self):
+        if not self.blocks:
+            return 0.0
+        return self.flat_blocks / float(self.blocks)
+
+    def __str__(self):
+        return ("%d frames, %.1f%% of blocks on the fast path (last frame %.1f%%, "
+                "lowest %.1f%%, highest %.1f%%)" %
+                (self.frames, 100*self.fraction(), 100*self.last,
+                 100*self.lowest, 100*self.highest))
+
+FAST_PATH_STATS = FastPathStats()
+
+
 # from zig-zag back to normal
 ZIG_ZAG_POSITIONS = array.array('B',
                                 ( 0,  1,  8, 16,  9,  2, 3, 10,
@@ -320,9 +434,139 @@ def _second_half(data):
     return [streamlen, tmp, eob]
 
 
-# Precompute all 12 and 15 bit values for the entropy decoding process
-FH = [_first_half(i) for i in xrange(2**12)]
-SH = [_second_half(i) for i in xrange(2**15)]
+# Width of the multi symbol lookup done by get_block_coeffs
+MS_BITS = 14
+MS_MASK = 2**MS_BITS-1
+MS_SHIFT = 64 - MS_BITS
+
+
+def _multi_symbol(data):
+    """Helper function to precompute all complete run/level pairs in a MS_BITS
+    wide datum.
+
+    Returns [streamlen, eob, pairs]. Only codes that FH and SH decode from their
+    own bits are taken, so streamlen is 0 if the first pair is too long.
+    """
+    streamlen = 0
+    pairs = []
+    while 1:
+        # the remaining bits, left aligned in 32 bits as get_block sees them
+        window = ((data << streamlen) & MS_MASK) << (32 - MS_BITS)
+        l1, run = FH[window >> 20]
+        if l1 > 12 or streamlen + l1 > MS_BITS:
+            break
+        window = (window << l1) & 0xffffffff
+        l2, level, eob = SH[window >> 17]
+        if l2 > 15 or streamlen + l1 + l2 > MS_BITS:
+            break
+        streamlen += l1 + l2
+        if eob:
+            return (streamlen, 1, tuple(pairs))
+        pairs.append((run, level))
+    return (streamlen, 0, tuple(pairs))
+
+
+# The entropy decoding tables are built by load_tables on the first decode.
+# FH and SH hold all 12 and 15 bit values, MS all MS_BITS values.
+FH = None
+SH = None
+MS = None
+
+# On disk cache of the tables. It holds flat int32 arrays after a small header,
+# so it can be memory mapped, bump TABLE_VERSION when the tables change.
+TABLE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'decoder_tables.cache')
+TABLE_VERSION = 1
+TABLE_MAGIC = 'ARDT'
+TABLE_HEADER = struct.Struct('<4sIIIII')
+
+
+def _build_tables():
+    """Compute the tables in python, returns FH, SH and MS."""
+    global FH, SH
+    FH = [_first_half(i) for i in xrange(2**12)]
+    SH = [_second_half(i) for i in xrange(2**15)]
+    return FH, SH, [_multi_symbol(i) for i in xrange(2**MS_BITS)]
+
+
+def _write_table_cache(fh, sh, ms, path):
+    """Flatten the tables and write them to path.
+
+    Layout after the header: fh length and value, sh length, value and eob, ms
+    length, eob and the start of its pairs, and the run and level of all pairs.
+    """
+    pairs = []
+    start = []
+    for streamlen, eob, p in ms:
+        start.append(len(pairs))
+        pairs.extend(p)
+    start.append(len(pairs))
+    columns = ([e[0] for e in fh], [e[1] for e in fh],
+               [e[0] for e in sh], [e[1] or 0 for e in sh], [int(e[2]) for e in sh],
+               [e[0] for e in ms], [e[1] for e in ms], start,
+               [p[0] for p in pairs], [p[1] for p in pairs])
+    tmp = path + '.' + str(os.getpid())
+    f = open(tmp, 'wb')
+    f.write(TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, MS_BITS, len(fh), len(sh), len(pairs)))
+    for column in columns:
+        f.write(np.array(column, dtype='<i4').tostring())
+    f.close()
+    os.rename(tmp, path)
+
+
+def _read_table_cache(path):
+    """Map the cache file at path and rebuild FH, SH and MS from it.
+
+    Returns None if there is no usable cache.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError):
+        f.close()
+        return None
+    f.close()
+    if len(buf) < TABLE_HEADER.size:
+        return None
+    magic, version, ms_bits, n_fh, n_sh, n_pairs = TABLE_HEADER.unpack_from(buf)
+    n_ms = 2**MS_BITS
+    lengths = (n_fh, n_fh, n_sh, n_sh, n_sh, n_ms, n_ms, n_ms + 1, n_pairs, n_pairs)
+    if (magic != TABLE_MAGIC or version != TABLE_VERSION or ms_bits != MS_BITS or
+        len(buf) != TABLE_HEADER.size + 4*sum(lengths)):
+        return None
+    offset = TABLE_HEADER.size
+    columns = []
+    for n in lengths:
+        columns.append(np.frombuffer(buf, dtype='<i4', count=n, offset=offset).tolist())
+        offset += 4*n
+    fh_len, fh_val, sh_len, sh_val, sh_eob, ms_len, ms_eob, start, run, level = columns
+
+    # the value of an eob entry in SH reads back as 0 rather than None, it is
+    # never used
+    pairs = zip(run, level)
+    ms = zip(ms_len, ms_eob, map(tuple, map(pairs.__getslice__, start[:-1], start[1:])))
+    return zip(fh_len, fh_val), zip(sh_len, sh_val, sh_eob), ms
+
+
+def load_tables(use_cache=True):
+    """Make FH, SH and MS available, from the cache if possible.
+
+    Called by the decoding functions on first use. The tables are computed
+    and written to TABLE_CACHE if it is missing or stale, a cache that can't be
+    written is not an error.
+    """
+    global FH, SH, MS
+    tables = _read_table_cache(TABLE_CACHE) if use_cache else None
+    if tables is None:
+        tables = _build_tables()
+        if use_cache:
+            try:
+                _write_table_cache(tables[0], tables[1], tables[2], TABLE_CACHE)
+            except (IOError, OSError), e:
+                print "Unable to write decoder table cache:", e
+    FH, SH, MS = tables
 
 
 def inverse_dct(block):
@@ -460,24 +704,47 @@ def get_pheader(bitreader):
     return width, height
 
 
+def get_frame_number(data):
+    """Return the frame number from the picture header of an image packet.
+
+    Only the header is read, so this is cheap compared to decoding.
+    """
+    reader = WordReader(data[:12])
+    psc = reader.read(22)
+    assert(psc == 0b0000000000000000100000)
+    reader.read(13)
+    return reader.read(32)
+
+
+def get_picture_size(data):
+    """Return the width and height from the picture header of an image
+    packet."""
+    return get_pheader(WordReader(data[:12]))
+
+
 def get_block(bitreader, has_coeff):
     """Read a 8x8 block from the data stream.
 
     This method takes care of the huffman-, RLE, zig-zag and idct and returns a
-    list of 64 ints.
+    list of 64 ints. Blocks with only a DC coefficient come out of the idct as
+    a constant DC >> 3, so they are filled with that directly.
     """
 
     # read the first 10 bits in a 16 bit datum
-    out_list = ZEROS[0:64]
-    out_list[0] = int(bitreader.read(10)) * IQUANT_TAB[0]
+    dc = int(bitreader.read(10)) * IQUANT_TAB[0]
     if not has_coeff:
-        return inverse_dct(out_list)
+        bitreader.flat_blocks += 1
+        return array.array('i', [dc >> 3]) * 64
+    out_list = ZEROS[0:64]
+    out_list[0] = dc
     i = 1
+    # no AC coefficient decoded yet
+    flat = True
     while 1:
         _ = bitreader.read(32*TRIES, False)
         streamlen = 0
         #######################################################################
-        for j in xrange(TRIES):
+        for k in xrange(TRIES):
             data = (_ << streamlen) & MASK
             data >>= SHIFT
 
@@ -490,9 +757,14 @@ def get_block(bitreader, has_coeff):
             streamlen += l
             if eob:
                 bitreader.read(streamlen)
+                if flat:
+                    # eob right away, no AC coefficients
+                    bitreader.flat_blocks += 1
+                    return array.array('i', [dc >> 3]) * 64
                 return inverse_dct(out_list)
             j = ZIG_ZAG_POSITIONS[i]
             out_list[j] = tmp*IQUANT_TAB[j]
+            flat = False
             i += 1
         #######################################################################
         bitreader.read(streamlen)
@@ -600,7 +872,11 @@ def read_picture(data):
     if data is None:
         print "no image data"
         return None
-    
+
+    # only this reference decoder needs the legacy opencv api
+    import cv2.cv as cv
+    if FH is None:
+        load_tables()
     bitreader = BitReader(data)
     t = datetime.datetime.now()
     width, height = get_pheader(bitreader)
@@ -614,13 +890,656 @@ def read_picture(data):
     bitreader.align()
     eos = bitreader.read(22)
     assert(eos == 0b0000000000000000111111)
+    FAST_PATH_STATS.add(slices * blocks * 6, bitreader.flat_blocks)
 
     t2 = datetime.datetime.now()
 
     return width, height, np.asarray(retarray), (t2 - t).microseconds / 1000000.0
 
+
+# Tables for the batched decoder. The coefficients are kept in zig-zag order
+# until dequantisation, so the quantization table is reordered to match.
+ZIG_ZAG_INDEX = np.array(ZIG_ZAG_POSITIONS, dtype=np.intp)
+IQUANT_ZIG_ZAG = np.array([IQUANT_TAB[j] for j in ZIG_ZAG_POSITIONS], dtype=np.int64)
+
+# Raster (row*16 + col) position in a macroblock -> index in the decoded
+# luma/chroma lists, ie. the inverse of MB_TO_GOB_MAP
+MB_RASTER_MAP = np.argsort(np.array(MB_TO_GOB_MAP, dtype=np.intp))
+MB_SCALE_MAP = np.array(SCALE_TAB, dtype=np.intp)[MB_RASTER_MAP]
+
+
+def get_block_coeffs(reader, has_coeff, coeffs, offset):
+    """Entropy decode a 8x8 block into coeffs[offset:offset+64].
+
+    Only the huffman and RLE steps are done here, the values are written in
+    zig-zag order and are not dequantized. The next MS_BITS of the stream are
+    looked up in MS, which yields every run/level pair that fits in them at
+    once. Pairs too long for the table are decoded one at a time through FH and
+    SH like get_block does.
+    """
+    coeffs[offset] = reader.read(10)
+    if not has_coeff:
+        reader.flat_blocks.append(offset >> 6)
+        return
+    words = reader.words
+    pos = reader.pos
+    lookups = 0
+    symbols = 0
+    i = offset + 1
+    while 1:
+        w = pos >> 5
+        chunk = words[w] << 32 | words[w + 1]
+        lookups += 1
+        streamlen, eob, pairs = MS[(chunk >> (MS_SHIFT - (pos & 31))) & MS_MASK]
+        if streamlen:
+            for run, level in pairs:
+                i += run
+                coeffs[i] = level
+                i += 1
+            symbols += len(pairs) + eob
+            pos += streamlen
+            if eob:
+                break
+        else:
+            data = (chunk >> (32 - (pos & 31))) & 0xffffffff
+            l, tmp = FH[data >> 20]
+            pos += l
+            data = (data << l) & 0xffffffff
+            i += tmp
+            l, tmp, eob = SH[data >> 17]
+            pos += l
+            symbols += 1
+            if eob:
+                break
+            coeffs[i] = tmp
+            i += 1
+    reader.pos = pos
+    reader.lookups += lookups
+    reader.symbols += symbols
+    if symbols == 1:
+        # eob right away
+        reader.flat_blocks.append(offset >> 6)
+
+
+def get_mb_coeffs(reader, coeffs, offset):
+    """Entropy decode the six blocks of a macro block into coeffs.
+
+    Returns False if the macro block was not coded.
+    """
+    mbc = reader.read(1)
+    if mbc != 0:
+        print "mbc was not zero"
+        return False
+    mbdesc = reader.read(8)
+    assert(mbdesc >> 7 & 1)
+    if mbdesc >> 6 & 1:
+        mbdiff = reader.read(2)
+    for b in xrange(6):
+        get_block_coeffs(reader, mbdesc >> b & 1, coeffs, offset + b*64)
+    return True
+
+
+def get_gob_coeffs(reader, coeffs, coded, slicenr, width):
+    """Entropy decode a group of blocks, see get_gob."""
+    if slicenr > 0:
+        reader.align()
+        gobsc = reader.read(22)
+        if gobsc == 0b0000000000000000111111:
+            print "weeeee"
+            return False
+        elif (not (gobsc & 0b0000000000000000100000) or
+             (gobsc & 0b1111111111111111000000)):
+            print "Got wrong GOBSC, aborting.", bin(gobsc)
+            return False
+        _ = reader.read(5)
+    mbs = width / 16
+    for i in xrange(mbs):
+        mb = slicenr*mbs + i
+        coded[mb] = get_mb_coeffs(reader, coeffs, mb*6*64)
+    return True
+
+
+def read_coefficients(data, gobs=None):
+    """Entropy decode a whole picture.
+
+    If gobs is given, decoding stops after that many rows of macro blocks and
+    the coefficients of the rest are left zero.
+    Returns width, height, an (n_blocks, 64) int array of zig-zag ordered
+    coefficients (six blocks per macro block: y0-y3, cb, cr), a bool array
+    telling which macro blocks were coded and a bool array telling which
+    blocks have no AC coefficients.
+    """
+    if MS is None:
+        load_tables()
+    t = time.time()
+    reader = WordReader(data)
+    width, height = get_pheader(reader)
+    n_mbs = (width / 16) * (height / 16)
+    coeffs = array.array('i', [0]) * (n_mbs*6*64)
+    coded = [False] * n_mbs
+
+    if gobs is None or gobs >= height / 16:
+        for i in xrange(0, height / 16):
+            get_gob_coeffs(reader, coeffs, coded, i, width)
+        reader.align()
+        eos = reader.read(22)
+        assert(eos == 0b0000000000000000111111)
+    else:
+        for i in xrange(0, gobs):
+            get_gob_coeffs(reader, coeffs, coded, i, width)
+    ENTROPY_STATS.add(reader, len(data), time.time() - t)
+    if gobs is None or gobs >= height / 16:
+        FAST_PATH_STATS.add(n_mbs*6, len(reader.flat_blocks))
+
+    coeffs = np.frombuffer(coeffs, dtype=np.intc).reshape(n_mbs*6, 64)
+    flat = np.zeros(n_mbs*6, dtype=bool)
+    flat[reader.flat_blocks] = True
+    return width, height, coeffs, np.array(coded, dtype=bool), flat
+
+
+def dequantize(coeffs):
+    """Dequantize and un-zig-zag an (n_blocks, 64) array of coefficients."""
+    blocks = np.empty(coeffs.shape, dtype=np.int64)
+    blocks[:, ZIG_ZAG_INDEX] = coeffs * IQUANT_ZIG_ZAG
+    return blocks
+
+
+def _idct_butterfly(c0, c1, c2, c3, c4, c5, c6, c7):
+    """One dimensional pass of inverse_dct on arrays, returns the eight
+    unscaled outputs.
+    """
+    z1 = (c2 + c6) * FIX_0_541196100
+    tmp2 = z1 + c6 * -FIX_1_847759065
+    tmp3 = z1 + c2 * FIX_0_765366865
+    tmp0 = (c0 + c4) << CONST_BITS
+    tmp1 = (c0 - c4) << CONST_BITS
+    tmp10 = tmp0 + tmp3
+    tmp13 = tmp0 - tmp3
+    tmp11 = tmp1 + tmp2
+    tmp12 = tmp1 - tmp2
+    z1 = c7 + c1
+    z2 = c5 + c3
+    z3 = c7 + c3
+    z4 = c5 + c1
+    z5 = (z3 + z4) * FIX_1_175875602
+    z1 = z1 * -FIX_0_899976223
+    z2 = z2 * -FIX_2_562915447
+    z3 = z3 * -FIX_1_961570560 + z5
+    z4 = z4 * -FIX_0_390180644 + z5
+    tmp0 = c7 * FIX_0_298631336 + z1 + z3
+    tmp1 = c5 * FIX_2_053119869 + z2 + z4
+    tmp2 = c3 * FIX_3_072711026 + z2 + z3
+    tmp3 = c1 * FIX_1_501321110 + z1 + z4
+    return (tmp10 + tmp3, tmp11 + tmp2, tmp12 + tmp1, tmp13 + tmp0,
+            tmp13 - tmp0, tmp12 - tmp1, tmp11 - tmp2, tmp10 - tmp3)
+
+
+def inverse_dct_batch(blocks):
+    """Inverse discrete cosine transform of an (n_blocks, 64) array.
+
+    Does the same integer arithmetic as inverse_dct, so the result is
+    identical, but for all blocks at once.
+    """
+    block = blocks.reshape(-1, 8, 8)
+    # columns
+    out = _idct_butterfly(*[block[:, k, :] for k in xrange(8)])
+    workspace = (np.stack(out, axis=1) + (1 << F1)) >> F2
+    # rows
+    out = _idct_butterfly(*[workspace[:, :, k] for k in xrange(8)])
+    return (np.stack(out, axis=2) >> F3).reshape(-1, 64)
+
+
+def inverse_dct_butterfly(coeffs):
+    """Dequantize and inverse transform an (n_blocks, 64) array of zig-zag
+    ordered coefficients with inverse_dct_batch."""
+    return inverse_dct_batch(dequantize(coeffs))
+
+
+# Each output of _idct_butterfly is an integer weighted sum of its inputs, with
+# no rounding inside, so a pass is a multiplication by this 8x8 matrix.
+IDCT_MATRIX = np.array([_idct_butterfly(*[np.array([int(k == j)]) for k in xrange(8)])
+                        for j in xrange(8)], dtype=np.int64)[:, :, 0].T
+IDCT_MATRIX_T = IDCT_MATRIX.T.astype(np.float64)
+# Zig-zag position -> position in the transposed block, and the quantization
+# table to match as floats
+ZIG_ZAG_INDEX_T = np.array([(i % 8) * 8 + i / 8 for i in ZIG_ZAG_POSITIONS], dtype=np.intp)
+IQUANT_ZIG_ZAG_FLOAT = IQUANT_ZIG_ZAG.astype(np.float64)
+# Largest dequantized coefficient for which both passes fit in an int32
+IDCT_INT32_LIMIT = min((2**31 - 1 - (1 << F1)) / int(np.abs(IDCT_MATRIX).sum(axis=1).max()),
+                       ((2**31 - 1) / int(np.abs(IDCT_MATRIX).sum(axis=1).max()) << F2) /
+                       int(np.abs(IDCT_MATRIX).sum(axis=1).max()))
+
+
+def inverse_dct_matrix(coeffs):
+    """Dequantize and inverse transform an (n_blocks, 64) array of zig-zag
+    ordered coefficients as two matrix multiplications over all blocks.
+
+    The products are summed exactly in float64 (they stay far below 2**53) and
+    rounded with the shifts of inverse_dct, so the result is identical to
+    inverse_dct_butterfly. Returns an (n_blocks, 64) int32 array.
+    """
+    n = coeffs.shape[0]
+    # dequantize into transposed blocks, so the column pass of every block is
+    # one (n*8, 8) x (8, 8) multiplication
+    blocks = np.empty((n, 64), dtype=np.float64)
+    blocks[:, ZIG_ZAG_INDEX_T] = coeffs * IQUANT_ZIG_ZAG_FLOAT
+    if n and max(blocks.max(), -blocks.min()) > IDCT_INT32_LIMIT:
+        dtype = np.int64
+    else:
+        dtype = np.int32
+    # columns
+    workspace = np.dot(blocks.reshape(-1, 8), IDCT_MATRIX_T).astype(dtype)
+    workspace += 1 << F1
+    workspace >>= F2
+    # rows, transposed back
+    workspace = workspace.reshape(n, 8, 8).transpose(0, 2, 1).astype(np.float64)
+    out = np.dot(workspace.reshape(-1, 8), IDCT_MATRIX_T).astype(dtype)
+    out >>= F3
+    return out.reshape(n, 64)
+
+
+# The idct used by the batched decoder, both give the same result
+IDCT_BACKENDS = {
+    'butterfly': inverse_dct_butterfly,
+    'matrix': inverse_dct_matrix,
+    }
+IDCT_BACKEND = 'matrix'
+
+
+def inverse_dct_fast(coeffs, flat):
+    """Dequantize and inverse transform an (n_blocks, 64) array of zig-zag
+    ordered coefficients with the IDCT_BACKEND, except for the blocks where
+    flat is set. Those have no AC coefficients and are filled with DC >> 3,
+    which is what the idct gives for them.
+    """
+    n_flat = np.count_nonzero(flat)
+    if not n_flat:
+        return IDCT_BACKENDS[IDCT_BACKEND](coeffs)
+    out = np.empty(coeffs.shape, dtype=np.int32)
+    out[flat] = ((coeffs[flat, 0] * IQUANT_TAB[0]) >> 3)[:, np.newaxis]
+    if n_flat < len(flat):
+        rest = ~flat
+        out[rest] = IDCT_BACKENDS[IDCT_BACKEND](coeffs[rest])
+    return out
+
+
+def ycbcr_to_rgb_batch(pixels, coded, width, height, out=None):
+    """Colour convert and assemble the picture from the idct output.
+
+    pixels is the (n_blocks, 64) output of the idct. The picture is
+    written to out, a C contiguous (height, width, 3) uint8 array, which is
+    allocated if not given. Returns out.
+    """
+    pixels = pixels.reshape(-1, 6, 64)
+    y = pixels[:, 0:4].reshape(-1, 256)[:, MB_RASTER_MAP] - 16
+    cb = pixels[:, 4][:, MB_SCALE_MAP] - 128
+    cr = pixels[:, 5][:, MB_SCALE_MAP] - 128
+    y = 298 * y + 128
+    rgb = np.empty(y.shape + (3,), dtype=np.int64)
+    rgb[..., 0] = y + 409 * cr
+    rgb[..., 1] = y - 100 * cb - 208 * cr
+    rgb[..., 2] = y + 516 * cb
+    rgb >>= 8
+    np.clip(rgb, 0, 255, out=rgb)
+    rgb[~coded] = 0
+
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    # write the macro blocks through a (gob, row, mb, col, channel) view of out
+    view = out.reshape(height / 16, 16, width / 16, 16, 3)
+    view[...] = rgb.reshape(height / 16, width / 16, 16, 16, 3).transpose(0, 2, 1, 3, 4)
+    return out
+
+
+class FramePool(object):
+    """A fixed number of reusable frame buffers for read_picture_into.
+
+    Buffers are handed out round robin, one set per picture size, so a frame
+    is overwritten again size frames later. Keep a copy if it is needed for
+    longer than that.
+    """
+
+    def __init__(self, size=2):
+        self.size = size
+        self.buffers = {}
+        # the last buffer handed out, per picture size
+        self.indexes = {}
+
+    def get(self, shape):
+        buffers = self.buffers.get(shape)
+        if buffers is None:
+            buffers = [np.empty(shape, dtype=np.uint8) for i in xrange(self.size)]
+            self.buffers[shape] = buffers
+        index = (self.indexes.get(shape, -1) + 1) % self.size
+        self.indexes[shape] = index
+        return buffers[index]
+
+
+def luma_to_gray_batch(pixels, coded, width, height, out=None):
+    """Assemble a single channel picture from the idct output of the luma
+    blocks alone.
+
+    pixels holds the four luma blocks of every macro block. The grey level is
+    what the colour conversion gives for that luma with neutral chroma. The
+    picture is written to out, a C contiguous (height, width) uint8 array,
+    which is allocated if not given. Returns out.
+    """
+    y = pixels.reshape(-1, 256)[:, MB_RASTER_MAP]
+    y = (298 * (y - 16) + 128) >> 8
+    np.clip(y, 0, 255, out=y)
+    y[~coded] = 0
+
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint8)
+    view = out.reshape(height / 16, 16, width / 16, 16)
+    view[...] = y.reshape(height / 16, width / 16, 16, 16).transpose(0, 2, 1, 3)
+    return out
+
+
+def _roi_macro_blocks(roi, width, height):
+    """Return the first and last + 1 macro block row and column covering roi,
+    an (x, y, width, height) rectangle in pixels."""
+    x, y, w, h = roi
+    if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > width or y + h > height:
+        raise ValueError("roi %s is outside the %dx%d picture" % (roi, width, height))
+    return y / 16, (y + h + 15) / 16, x / 16, (x + w + 15) / 16
+
+
+def _decode_batched(data, out, luma_only, roi=None):
+    """The batched pipeline behind read_picture_batched and read_picture_into.
+
+    With luma_only the chroma blocks are entropy decoded, as they must be
+    parsed, but skip the idct and colour conversion. With a roi only the
+    macro blocks covering it get past entropy decoding, and entropy decoding
+    stops after the last row of them.
+    """
+    if roi is None:
+        width, height, coeffs, coded, flat = read_coefficients(data)
+        shape = (height, width)
+    else:
+        width, height = get_picture_size(data)
+        r0, r1, c0, c1 = _roi_macro_blocks(roi, width, height)
+        width, height, coeffs, coded, flat = read_coefficients(data, r1)
+        mb_cols = width / 16
+        coeffs = coeffs.reshape(height / 16, mb_cols, 6 * 64)[r0:r1, c0:c1].reshape(-1, 64)
+        coded = coded.reshape(height / 16, mb_cols)[r0:r1, c0:c1].ravel()
+        flat = flat.reshape(height / 16, mb_cols, 6)[r0:r1, c0:c1].ravel()
+        width, height = (c1 - c0) * 16, (r1 - r0) * 16
+        shape = (roi[3], roi[2])
+
+    if luma_only:
+        coeffs = coeffs.reshape(-1, 6, 64)[:, 0:4].reshape(-1, 64)
+        flat = flat.reshape(-1, 6)[:, 0:4].ravel()
+    else:
+        shape += (3,)
+
+    if isinstance(out, FramePool):
+        out = out.get(shape)
+    elif out is not None and (out.shape != shape or out.dtype != np.uint8 or
+                              not out.flags.c_contiguous):
+        raise ValueError("can't decode a %dx%d picture into a %s %s array" %
+                         (shape[1], shape[0], out.shape, out.dtype))
+
+    # an roi not on macro block borders is assembled whole and then cut out
+    aligned = shape[0:2] == (height, width)
+    picture = out if aligned else None
+
+    pixels = inverse_dct_fast(coeffs, flat)
+    if luma_only:
+        picture = luma_to_gray_batch(pixels, coded, width, height, picture)
+    else:
+        picture = ycbcr_to_rgb_batch(pixels, coded, width, height, picture)
+
+    if aligned:
+        out = picture
+    else:
+        x, y = roi[0] - c0 * 16, roi[1] - r0 * 16
+        crop = picture[y:y + shape[0], x:x + shape[1]]
+        if out is None:
+            out = np.ascontiguousarray(crop)
+        else:
+            out[...] = crop
+    return shape[1], shape[0], out
+
+
+def read_picture_into(data, out, luma_only=False, roi=None):
+    """Decode an AR.Drone image packet into a preallocated array.
+
+    out is either a C contiguous uint8 array of the picture's shape or a
+    FramePool to take one from. Apart from that it works like
+    read_picture_batched.
+    Returns: width, height, image and time to decode the image
+    """
+    if data is None:
+        print "no image data"
+        return None
+
+    t = datetime.datetime.now()
+    width, height, image = _decode_batched(data, out, luma_only, roi)
+    t2 = datetime.datetime.now()
+
+    return width, height, image, (t2 - t).microseconds / 1000000.0
+
+
+def read_picture_batched(data, luma_only=False, roi=None):
+    """Convert an AR.Drone image packet to a numpy image.
+
+    Same result as read_picture, but only the entropy decoding is done per
+    block, dequantisation, idct and colour conversion run on all blocks of the
+    picture at once. With luma_only a (height, width) grey image is returned,
+    which costs about a third less than colour. With roi, an (x, y, width,
+    height) rectangle, only that part of the picture is decoded and returned,
+    eg. (0, 0, 88, 72) for the bottom camera inset of the combined channels.
+    Returns: width, height, image and time to decode the image
+    """
+    if data is None:
+        print "no image data"
+        return None
+
+    t = datetime.datetime.now()
+    width, height, image = _decode_batched(data, None, luma_only, roi)
+    t2 = datetime.datetime.now()
+
+    return width, height, image, (t2 - t).microseconds / 1000000.0
+
+
+# Drone state bits in the navdata header, see navdata_common.h
+DRONE_STATE_BITS = (
+    ('fly_mask',             0), # FLY MASK : (0) ardrone is landed, (1) ardrone is flying
+    ('video_mask',           1), # VIDEO MASK : (0) video disable, (1) video enable
+    ('vision_mask',          2), # VISION MASK : (0) vision disable, (1) vision enable */
+    ('control_mask',         3), # CONTROL ALGO (0) euler angles control, (1) angular speed control */
+    ('altitude_mask',        4), # ALTITUDE CONTROL ALGO : (0) altitude control inactive (1) altitude control active */
+    ('user_feedback_start',  5), # USER feedback : Start button state */
+    ('command_mask',         6), # Control command ACK : (0) None, (1) one received */
+    ('fw_file_mask',         7), # Firmware file is good (1) */
+    ('fw_ver_mask',          8), # Firmware update is newer (1) */
+    ('fw_upd_mask',          9), # Firmware update is ongoing (1) */
+    ('navdata_demo_mask',   10), # Navdata demo : (0) All navdata, (1) only navdata demo */
+    ('navdata_bootstrap',   11), # Navdata bootstrap : (0) options sent in all or demo mode, (1) no navdata options sent */
+    ('motors_mask',         12), # Motor status : (0) Ok, (1) Motors problem */
+    ('com_lost_mask',       13), # Communication lost : (1) com problem, (0) Com is ok */
+    ('vbat_low',            15), # VBat low : (1) too low, (0) Ok */
+    ('user_el',             16), # User Emergency Landing : (1) User EL is ON, (0) User EL is OFF*/
+    ('timer_elapsed',       17), # Timer elapsed : (1) elapsed, (0) not elapsed */
+    ('angles_out_of_range', 19), # Angles : (0) Ok, (1) out of range */
+    ('ultrasound_mask',     21), # Ultrasonic sensor : (0) Ok, (1) deaf */
+    ('cutout_mask',         22), # Cutout system detection : (0) Not detected, (1) detected */
+    ('pic_version_mask',    23), # PIC Version number OK : (0) a bad version number, (1) version number is OK */
+    ('atcodec_thread_on',   24), # ATCodec thread ON : (0) thread OFF (1) thread ON */
+    ('navdata_thread_on',   25), # Navdata thread ON : (0) thread OFF (1) thread ON */
+    ('video_thread_on',     26), # Video thread ON : (0) thread OFF (1) thread ON */
+    ('acq_thread_on',       27), # Acquisition thread ON : (0) thread OFF (1) thread ON */
+    ('ctrl_watchdog_mask',  28), # CTRL watchdog : (1) delay in control execution (> 5ms), (0) control is well scheduled */
+    ('adc_watchdog_mask',   29), # ADC Watchdog : (1) delay in uart2 dsr (> 5ms), (0) uart2 is good */
+    ('com_watchdog_mask',   30), # Communication Watchdog : (1) com problem, (0) Com is ok */
+    ('emergency_mask',      31), # Emergency landing : (0) no emergency, (1) emergency */
+    )
+
+
+def drone_state(state):
+    """Return the drone state word of a navdata packet as a dict of flag name
+    to bit."""
+    return dict([(name, state >> bit & 1) for name, bit in DRONE_STATE_BITS])
+
+
+def _navdata_demo(values):
+    # convert the millidegrees into degrees and round to int, as they are not
+    # so precise anyways
+    for i in 'theta', 'phi', 'psi':
+        values[i] = values[i] / 1000
+    psi = values['psi']
+    values['psi'] = psi if psi > 0 else 360+psi
+    return values
+
+NAVDATA_HEADER = struct.Struct("IIII")
+NAVDATA_OPTION_HEADER = struct.Struct("HH")
+# Option id -> layout, field names and a function to post process the values
+# with. The other options are returned as a list of characters.
+NAVDATA_OPTIONS = {
+    0: (struct.Struct("IIfffIfffI"),
+        ('ctrl_state', 'battery', 'theta', 'phi', 'psi', 'altitude', 'vx', 'vy', 'vz', 'num_frames'),
+        _navdata_demo),
+    2: (struct.Struct("HHHHHHHHHHHHHHHHH"),
+        ('ra_x', 'ra_y', 'ra_z', 'rg_x', 'rg_y', 'rg_z', 'rg_110_x', 'rg_110_y', 'r_vbat',
+         'us_debut_echo', 'us_fin_echo', 'us_assoc_echo', 'us_dist_echo', 'us_courbe_temps',
+         'us_courbe_valeur', 'us_courbe_ref', 'flag_echo_ini'),
+        None),
+    10: (struct.Struct("ifiifffffIffI"),
+         ('altitude_vision', 'altitude_vz', 'altitude_ref', 'altitude_raw', 'obs_accZ',
+          'obs_alt', 'obs_x', 'obs_state', 'est_vb', 'est_state'),
+         None),
+    16: (struct.Struct("IIIIIIIIIIIIIIIIIIIIIIIIIf"),
+         ('num', 't1', 't2', 't3', 't4', 'x1', 'x2', 'x3', 'x4', 'y1', 'y2', 'y3', 'y4',
+          'w1', 'w2', 'w3', 'w4', 'h1', 'h2', 'h3', 'h4', 'd1', 'd2', 'd3', 'd4',
+          'ori1', 'ori2', 'ori3', 'ori4'),
+         None),
+    }
+
+
 def decode_navdata(packet):
-    """Decode a navdata packet."""
+    """Decode a navdata packet.
+
+    packet can be a string or any buffer, like a memoryview of a receive
+    buffer, the options are unpacked straight out of it. Returns a dict with
+    the header fields, the drone state and a dict per option id.
+    """
+
+    if packet is None:
+        return None
+
+    header, state, seq_nr, vision_flag = NAVDATA_HEADER.unpack_from(packet, 0)
+    data = {}
+    data['drone_state'] = drone_state(state)
+    data['header'] = header
+    data['seq_nr'] = seq_nr
+    data['vision_flag'] = vision_flag
+
+    offset = NAVDATA_HEADER.size
+    end = len(packet)
+    while offset + NAVDATA_OPTION_HEADER.size <= end:
+        id_nr, size = NAVDATA_OPTION_HEADER.unpack_from(packet, offset)
+        offset += NAVDATA_OPTION_HEADER.size
+        length = size - NAVDATA_OPTION_HEADER.size
+        if offset + length > end:
+            raise struct.error("navdata option %d runs past the end of the packet" % id_nr)
+        option = NAVDATA_OPTIONS.get(id_nr)
+        if option is None:
+            values = list(packet[offset:offset + length])
+        else:
+            layout, names, convert = option
+            if length < layout.size:
+                raise struct.error("navdata option %d is %d bytes, not %d" % (id_nr, length, layout.size))
+            values = dict(zip(names, layout.unpack_from(packet, offset)))
+            if convert is not None:
+                values = convert(values)
+        offset += max(length, 0)
+        data[id_nr] = values
+    return data
+
+
+class NavdataView(collections.Mapping):
+    """A navdata packet, decoded one option at a time as they are looked up.
+
+    Building the view only walks the option headers to note where each option
+    is, unknown and unused options are never copied. A looked up option is
+    decoded like decode_navdata does it and kept. The view reads the same as
+    the dict decode_navdata returns, and dict(view) is equal to it.
+    """
+
+    HEADER_KEYS = ('drone_state', 'header', 'seq_nr', 'vision_flag')
+
+    def __init__(self, packet):
+        # a buffer into a receive ring may be overwritten later, keep a copy
+        if not isinstance(packet, str):
+            packet = str(packet)
+        self.packet = packet
+        self.header, self.state, self.seq_nr, self.vision_flag = NAVDATA_HEADER.unpack_from(packet, 0)
+        self.options = {}
+        self.decoded = {}
+
+        offset = NAVDATA_HEADER.size
+        end = len(packet)
+        while offset + NAVDATA_OPTION_HEADER.size <= end:
+            id_nr, size = NAVDATA_OPTION_HEADER.unpack_from(packet, offset)
+            offset += NAVDATA_OPTION_HEADER.size
+            length = max(size - NAVDATA_OPTION_HEADER.size, 0)
+            if offset + length > end:
+                raise struct.error("navdata option %d runs past the end of the packet" % id_nr)
+            self.options[id_nr] = (offset, length)
+            offset += length
+
+    def __getitem__(self, key):
+        values = self.decoded.get(key)
+        if values is not None:
+            return values
+        if key in self.options:
+            offset, length = self.options[key]
+            option = NAVDATA_OPTIONS.get(key)
+            if option is None:
+                values = list(self.packet[offset:offset + length])
+            else:
+                layout, names, convert = option
+                if length < layout.size:
+                    raise struct.error("navdata option %d is %d bytes, not %d" % (key, length, layout.size))
+                values = dict(zip(names, layout.unpack_from(self.packet, offset)))
+                if convert is not None:
+                    values = convert(values)
+        elif key == 'drone_state':
+            values = drone_state(self.state)
+        elif key in self.HEADER_KEYS:
+            return getattr(self, key)
+        else:
+            raise KeyError(key)
+        self.decoded[key] = values
+        return values
+
+    def __contains__(self, key):
+        return key in self.options or key in self.HEADER_KEYS
+
+    def __iter__(self):
+        return iter(self.HEADER_KEYS + tuple(self.options))
+
+    def __len__(self):
+        return len(self.HEADER_KEYS) + len(self.options)
+
+
+def decode_navdata_lazy(packet):
+    """Return a NavdataView of a navdata packet, or None without a packet.
+
+    Cheaper than decode_navdata when only some options of a full navdata
+    packet are used.
+    """
+    if packet is None:
+        return None
+    return NavdataView(packet)
+
+
+def decode_navdata_bytewise(packet):
+    """Decode a navdata packet a byte at a time.
+
+    The original navdata decoder, kept to check decode_navdata against.
+    """
 
     if packet is None:
         return None
@@ -710,6 +1629,10 @@ try:
     psyco.bind(get_mb)
     psyco.bind(inverse_dct)
     psyco.bind(read_picture)
+    psyco.bind(WordReader)
+    psyco.bind(get_block_coeffs)
+    psyco.bind(get_mb_coeffs)
+    psyco.bind(get_gob_coeffs)
     #psyco.bind(decode_navdata)
 except NameError:
     print "Unable to bind video decoding methods with psyco. Proceeding anyways, but video decoding will be slow!"
@@ -717,8 +1640,6 @@ except NameError:
 
 # # __________  Entry point for stand-alone builds __________
 
-import time
-
 def entry_point(argv):
     import os
     if len(argv) > 1:
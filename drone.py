@@ -28,6 +28,7 @@ import threading
 import controllers
 import receivers
 import virtualsensors
+import eventloop
 import newesttasks as tasks
 import utils
 import settings
@@ -37,7 +38,7 @@ import map
 class Drone(object):
 
 
-    def __init__(self, test):
+    def __init__(self, test, headless=False):
 
 
         if test:
@@ -51,7 +52,7 @@ class Drone(object):
 
         self.sensors = []
 
-        self.video_sensor = receivers.VideoReceiver(settings.VIDEO_PORT)
+        self.video_sensor = receivers.VideoReceiver(settings.VIDEO_PORT, settings.DECODE_WORKERS)
         self.sensors.append(self.video_sensor)
         
         self.wifi_sensor = receivers.WifiReceiver(settings.WIFI_PORT)
@@ -59,16 +60,29 @@ class Drone(object):
         
         self.navdata_sensor = receivers.NavdataReceiver(settings.NAVDATA_PORT)
         self.sensors.append(self.navdata_sensor)
+
+        self.event_loop = None
+        if settings.EVENT_LOOP:
+            self.event_loop = eventloop.SensorLoop()
+            for sensor in self.sensors:
+                self.event_loop.add(sensor)
+        elif settings.RECEIVER_HUB:
+            self.receiver_hub = receivers.ReceiverHub()
+            for sensor in self.sensors:
+                self.receiver_hub.add(sensor)
         
-        self.interface = controllers.ControllerInterface()
+        self.interface = controllers.ControllerInterface(self.event_loop)
 
         self.task_manager = tasks.TaskManager(self)
-        self.controller_manager = controllers.ControllerManager(self)
+        self.controller_manager = controllers.ControllerManager(self, not headless)
             
     def get_sensors(self):
         return self.sensors
 
     def start(self):
+        if self.event_loop is not None:
+            self.event_loop.start()
+
         self.position_detector = virtualsensors.PositionDetector(self) 
         self.sensors.append(self.position_detector)
 
@@ -111,6 +125,8 @@ class Drone(object):
         
         self.controller_manager.stop()
         self.task_manager.stop()
+        if self.event_loop is not None:
+            self.event_loop.stop()
         return 0
 
     def get_map(self):
@@ -122,6 +138,9 @@ class Drone(object):
     def get_distance_sensor(self):
         return self.distance_tracker
 
+    def get_event_loop(self):
+        return self.event_loop
+
     def get_task_manager(self):
         return self.task_manager
 
@@ -0,0 +1,273 @@
+#!/usr/bin/env python2.7
+#    Copyright (c) 2012 Morten Daugaard
+#
+#    Permission is hereby granted, free of charge, to any person obtaining a copy
+#    of this software and associated documentation files (the "Software"), to deal
+#    in the Software without restriction, including without limitation the rights
+#    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#    copies of the Software, and to permit persons to whom the Software is
+#    furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+
+""" The eventloop module runs the receivers, virtual sensors and the AT command
+watchdog on one thread instead of a thread or process each.
+
+The loop waits on the receiver sockets with epoll and on a heap of timers, so
+it sleeps until a packet comes or something is due. Periodic work is written
+as coroutines, generators which yield the number of seconds to sleep, or a Job
+from SensorLoop.run_in_executor to wait for work done by the worker threads.
+The same coroutines run without a loop in a thread of their own with spawn.
+"""
+
+import os
+import time
+import heapq
+import fcntl
+import select
+import datetime
+import threading
+import traceback
+import multiprocessing.pool
+from collections import OrderedDict
+from collections import deque
+
+import settings
+
+
+def run_blocking(coroutine):
+    """Run a coroutine in the calling thread, sleeping where it yields a
+    delay."""
+    for delay in coroutine:
+        time.sleep(delay)
+
+
+def spawn(loop, coroutine):
+    """Run a coroutine on loop, or in a new thread if loop is None."""
+    if loop is None:
+        threading.Thread(target=run_blocking, args=(coroutine,)).start()
+    else:
+        loop.spawn(coroutine)
+
+
+class Job(object):
+    """A call made by the worker threads, yielded by a coroutine to get its
+    result, or its exception raised, when it is done."""
+
+    def __init__(self, loop, function, args):
+        self.loop = loop
+        self.function = function
+        self.args = args
+
+    def start(self, coroutine):
+        self.loop.executor.apply_async(self.run, (coroutine,))
+
+    def run(self, coroutine):
+        try:
+            result, error = self.function(*self.args), None
+        except Exception, e:
+            result, error = None, e
+        self.loop.call_soon_threadsafe(self.loop.step, coroutine, result, error)
+
+
+class SensorLoop(threading.Thread):
+    """One thread running the receivers and the periodic work of the drone.
+
+    Receivers added to the loop are polled here instead of in a process of
+    their own, like with a ReceiverHub. Coroutines are run with spawn, work
+    too heavy for the loop thread, like decoding and detection, is given to
+    the worker threads with run_in_executor.
+    """
+
+    def __init__(self, workers=settings.EVENT_LOOP_WORKERS):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stopping = False
+        self.epoll = select.epoll()
+        self.readers = {}
+        # (due time, number, callback, args), the number keeps the order of
+        # callbacks due at the same time
+        self.timers = []
+        self.timer_count = 0
+        self.pending = deque()
+
+        # written to by other threads to wake the loop up
+        self.wake_read, self.wake_write = os.pipe()
+        fcntl.fcntl(self.wake_read, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.epoll.register(self.wake_read, select.EPOLLIN)
+
+        self.executor = multiprocessing.pool.ThreadPool(workers)
+
+        # per receiver: history, capture log, packets, packets at last init
+        self.receivers = []
+        self.receiving = OrderedDict()
+        self.time_start = datetime.datetime.now()
+
+    def add_reader(self, sock, callback):
+        """Call callback in the loop whenever sock is readable."""
+        self.readers[sock.fileno()] = callback
+        self.epoll.register(sock.fileno(), select.EPOLLIN)
+
+    def remove_reader(self, sock):
+        fd = sock.fileno()
+        if self.readers.pop(fd, None) is not None:
+            self.epoll.unregister(fd)
+
+    def call_at(self, due, callback, *args):
+        """Call callback in the loop at the time.time() due."""
+        self.timer_count += 1
+        heapq.heappush(self.timers, (due, self.timer_count, callback, args))
+
+    def call_later(self, delay, callback, *args):
+        self.call_at(time.time() + delay, callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Call callback in the loop as soon as possible, from any thread."""
+        self.pending.append((callback, args))
+        os.write(self.wake_write, 'x')
+
+    def call_and_wait(self, callback, *args):
+        """Call callback in the loop and wait for it to finish, from any
+        thread."""
+        if not self.is_alive() or threading.current_thread() is self:
+            callback(*args)
+            return
+        done = threading.Event()
+        def call():
+            try:
+                callback(*args)
+            finally:
+                done.set()
+        self.call_soon_threadsafe(call)
+        done.wait(2)
+
+    def run_in_executor(self, function, *args):
+        """Return a Job calling function in a worker thread, for a coroutine
+        to yield."""
+        return Job(self, function, args)
+
+    def spawn(self, coroutine):
+        """Start running a coroutine in the loop, from any thread."""
+        self.call_soon_threadsafe(self.step, coroutine)
+
+    def step(self, coroutine, value=None, error=None, due=None):
+        """Resume a coroutine and schedule it again by what it yields.
+
+        Sleeps are counted from the time the coroutine was due, not from when
+        it got to run, so periodic work keeps its rate.
+        """
+        if due is None:
+            due = time.time()
+        try:
+            if error is not None:
+                request = coroutine.throw(error)
+            else:
+                request = coroutine.send(value)
+        except StopIteration:
+            return
+        except Exception:
+            traceback.print_exc()
+            return
+        if isinstance(request, Job):
+            request.start(coroutine)
+        else:
+            # a coroutine that fell behind starts again from now instead of
+            # running the missed sleeps back to back
+            due = max(due + (request or 0), time.time())
+            self.call_at(due, self.step, coroutine, None, None, due)
+
+    def run(self):
+        while not self.stopping:
+            if self.pending:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, self.timers[0][0] - time.time())
+            else:
+                timeout = 1
+            for fd, event in self.epoll.poll(timeout):
+                if fd == self.wake_read:
+                    try:
+                        os.read(self.wake_read, 4096)
+                    except OSError:
+                        pass
+                    continue
+                callback = self.readers.get(fd)
+                if callback is not None:
+                    self.call(callback, ())
+
+            while self.pending:
+                callback, args = self.pending.popleft()
+                self.call(callback, args)
+
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now and not self.stopping:
+                due, count, callback, args = heapq.heappop(self.timers)
+                self.call(callback, args)
+
+        self.executor.terminate()
+        self.epoll.close()
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+        print 'Shutting down sensor loop\r'
+
+    def call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def stop(self):
+        self.stopping = True
+        if self.is_alive():
+            os.write(self.wake_write, 'x')
+            self.join()
+
+    def add(self, receiver):
+        """Receive for receiver in the loop from when it is started."""
+        receiver.hub = self
+        self.receivers.append(receiver)
+
+    def receiver_started(self, receiver):
+        self.call_soon_threadsafe(self.start_receiver, receiver)
+
+    def receiver_stopped(self, receiver):
+        self.call_and_wait(self.stop_receiver, receiver)
+
+    def start_receiver(self, r):
+        print 'Starting receiver ', r.PORT, 'in the sensor loop\r'
+        self.receiving[r] = [OrderedDict(), r.new_capture(), 0, 0]
+        r.init()
+        self.add_reader(r.sock, lambda: self.receive(r))
+        self.spawn(self.keep_receiving(r))
+
+    def stop_receiver(self, r):
+        s = self.receiving.pop(r, None)
+        if s is not None:
+            self.remove_reader(r.sock)
+            r.shutdown(s[1], s[2], self.time_start)
+
+    def receive(self, r):
+        s = self.receiving[r]
+        s[2] += r.receive_batch(r.get_status(), s[0], s[1])
+        # ask for more data every 50 packets
+        if s[2] - s[3] >= 50:
+            r.init()
+            s[3] = s[2]
+
+    def keep_receiving(self, r):
+        """Ask for more data every second while nothing comes."""
+        while r in self.receiving:
+            runs = self.receiving[r][2]
+            yield 1.0
+            s = self.receiving.get(r)
+            if s is not None and s[2] == runs:
+                r.init()
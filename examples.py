@@ -55,6 +55,37 @@ def test_decode():
     t2 = time.time()
     print 'time: ', t2-t1
 
+def test_decode_batched():
+    import decoder
+    import os
+    import numpy as np
+
+    i = 1
+    mismatches = 0
+    while os.path.isfile('./testdata/' + str(i) + '.dat'):
+        frame = open('./testdata/' + str(i) + '.dat').read()
+        ref = decoder.read_picture(frame)[2]
+        res = decoder.read_picture_batched(frame)[2]
+        if not np.array_equal(ref, res):
+            print 'frame', i, 'differs'
+            mismatches += 1
+        i += 1
+    print i-1, 'frames compared,', mismatches, 'mismatches'
+
+def test_entropy_decode():
+    import decoder
+    import os
+
+    decoder.ENTROPY_STATS.reset()
+    decoder.FAST_PATH_STATS.reset()
+    i = 1
+    while os.path.isfile('./testdata/' + str(i) + '.dat'):
+        frame = open('./testdata/' + str(i) + '.dat').read()
+        decoder.read_coefficients(frame)
+        i += 1
+    print decoder.ENTROPY_STATS
+    print decoder.FAST_PATH_STATS
+
 
 def qrscan():
     import testdevice, settings, receivers, zbar, Image
@@ -36,6 +36,7 @@ import pickle
 import Gnuplot, Gnuplot.funcutils
 import pdb
 import random
+import eventloop
 
 
 """ Context format : ['point of blob', root task reference, currect distance travelled ] """
@@ -51,20 +52,35 @@ class TaskManager(object):
         self.active_tasks = []
         self.lock = threading.Lock()
         self.required_runlevel = 0
+        # seconds between letting the tasks move, the rate the interface
+        # sends movements at while flying
+        self.loop_sleep = 0.02
 
     def start(self):
-        threading.Thread(target=self.runner).start()
+        loop = self.drone.get_event_loop()
+        eventloop.spawn(loop, self.moving(loop))
 
     def runner(self):
-       
+        eventloop.run_blocking(self.moving())
+
+    def moving(self, loop=None):
+        """ The task loop as a coroutine, with a SensorLoop as loop the moves are made
+        by its worker threads as some of them sleep """
         while not self.stopping:
-            # for t in self.active_tasks:
-            #     print t.level
-            # print '************'
-       
-            for t in self.active_tasks:
-                if t.domove():
-                    break
+            if loop is None:
+                self.move_once()
+            else:
+                yield loop.run_in_executor(self.move_once)
+            yield self.loop_sleep
+
+    def move_once(self):
+        # for t in self.active_tasks:
+        #     print t.level
+        # print '************'
+   
+        for t in self.active_tasks:
+            if t.domove():
+                break
 
     def kill_tasks(self):
         self.lock.acquire()
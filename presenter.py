@@ -204,7 +204,7 @@ class PresenterGui(object):
 
         input_image_small = self.detector.last_small
         if input_image_small is not None:
-            
+            input_image_small = input_image_small.copy()
             for p in self.detector.points:
                 cv2.circle(input_image_small, (int(p[0]), int(p[1])), 2, (255, 255, 255), 10)
      
@@ -221,6 +221,7 @@ class PresenterGui(object):
 
         input_image_large = self.detector.last_large # self.video_sensor.get_data()
         if input_image_large is not None:
+            input_image_large = input_image_large.copy()
             for x,y,w,h in self.detector.silhouets:
                 pad_w, pad_h = int(0.15*w), int(0.05*h)
                 cv2.rectangle(input_image_large, (x+pad_w, y+pad_h), (x+w-pad_w, y+h-pad_h), (0, 255, 0), 2)
@@ -733,7 +734,8 @@ class VideoWindow(gtk.Window):
         new image data from the video receiver. As a part of development the method 
         also carries out optical flow tracking of features in 'self.features'."""
 
-        input_image = self.video_sensor.get_data()
+        # copy, the receiver hands the same frame to every caller
+        input_image = self.video_sensor.get_data().copy()
         
         points = self.print_points(self.task_manager.active_tasks)
 
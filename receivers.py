@@ -22,6 +22,9 @@
 import datetime
 import time
 import math
+import errno
+import mmap
+import struct
 import threading
 import socket
 import multiprocessing
@@ -31,31 +34,127 @@ import pickle
 from collections import OrderedDict
 from collections import deque
 
+import numpy as np
 import cv2.cv as cv
 import cv2
 
 import utils
+import capturelog
 import decoder
 import settings
 
+class SharedRing(object):
+    """Ring buffer holding the last packets in shared memory.
+
+    Written by one process, read by any number of others. The memory is an
+    anonymous shared mmap, so the ring must be created before forking. Every
+    slot starts with the sequence number of the packet in it, which the writer
+    clears while it overwrites the slot, so readers can tell whether the slot
+    they read is still intact without any lock. Strings are stored as they are
+    and read back as buffers into the shared memory, anything else is pickled.
+    """
+
+    HEADER = struct.Struct('<qi')   # newest sequence number, status
+    COUNTS = struct.Struct('<qqq')  # received, coalesced, dropped packets
+    SLOT = struct.Struct('<qIBxxxd')    # sequence number, length, pickled, time.time() put
+    HEADER_SIZE = 40
+    SLOT_HEADER_SIZE = 24
+
+    def __init__(self, slots=16, slot_size=65535):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = self.SLOT_HEADER_SIZE + ((slot_size + 7) & ~7)
+        self.mem = mmap.mmap(-1, self.HEADER_SIZE + slots*self.stride)
+        self.HEADER.pack_into(self.mem, 0, -1, settings.INIT)
+        self.COUNTS.pack_into(self.mem, 16, 0, 0, 0)
+        self.seq = -1
+
+    def put(self, data):
+        """Publish data as the newest packet, only one process may do this."""
+        pickled = not isinstance(data, str)
+        if pickled:
+            data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size:
+            raise ValueError('packet of %d bytes does not fit in a %d byte slot' % (len(data), self.slot_size))
+        self.seq += 1
+        offset = self.HEADER_SIZE + (self.seq % self.slots)*self.stride
+        self.SLOT.pack_into(self.mem, offset, -1, 0, 0, 0)
+        start = offset + self.SLOT_HEADER_SIZE
+        self.mem[start:start + len(data)] = data
+        self.SLOT.pack_into(self.mem, offset, self.seq, len(data), pickled, time.time())
+        struct.pack_into('<q', self.mem, 0, self.seq)
+        return self.seq
+
+    def get_latest(self):
+        """Return the sequence number and data of the newest packet.
+
+        The data is a buffer into the shared memory, not a copy, so it is only
+        valid as long as is_valid(seq) is True. Returns (-1, None) before the
+        first packet.
+        """
+        while 1:
+            seq = struct.unpack_from('<q', self.mem, 0)[0]
+            if seq < 0:
+                return seq, None
+            offset = self.HEADER_SIZE + (seq % self.slots)*self.stride
+            slot_seq, length, pickled, put_time = self.SLOT.unpack_from(self.mem, offset)
+            if slot_seq != seq:
+                continue
+            start = offset + self.SLOT_HEADER_SIZE
+            if pickled:
+                data = pickle.loads(self.mem[start:start + length])
+                if not self.is_valid(seq):
+                    continue
+            else:
+                data = buffer(self.mem, start, length)
+            return seq, data
+
+    def is_valid(self, seq):
+        """Whether the slot of packet seq still holds it."""
+        offset = self.HEADER_SIZE + (seq % self.slots)*self.stride
+        return struct.unpack_from('<q', self.mem, offset)[0] == seq
+
+    def get_time(self, seq):
+        """Return the time packet seq was put, or None if it is gone."""
+        offset = self.HEADER_SIZE + (seq % self.slots)*self.stride
+        slot_seq, length, pickled, put_time = self.SLOT.unpack_from(self.mem, offset)
+        return put_time if slot_seq == seq else None
+
+    def get_status(self):
+        return struct.unpack_from('<i', self.mem, 8)[0]
+
+    def set_status(self, arg):
+        struct.pack_into('<i', self.mem, 8, arg)
+
+    def add_counts(self, received, coalesced, dropped):
+        """Add to the packet counters, only the writer may do this."""
+        counts = self.COUNTS.unpack_from(self.mem, 16)
+        self.COUNTS.pack_into(self.mem, 16, counts[0] + received, counts[1] + coalesced,
+                              counts[2] + dropped)
+
+    def get_counts(self):
+        """Return the number of packets received, coalesced and dropped."""
+        return self.COUNTS.unpack_from(self.mem, 16)
+
+
 class Receiver(multiprocessing.Process):
 
-    def __init__(self, port):
+    def __init__(self, port, slots=16):
 
-        # Communication between parent and child process happens via a shared list 'comlist', the fields represents the following values:
-        # comlist[0] : first data hold
-        # comlist[1] : second data hold
-        # comlist[2] : int describing the currently readable data hold
-        # comlist[3] : int describing whether the process is running normally or shutting down
-       
-        manager = multiprocessing.Manager()
-        self.comlist = manager.list(range(4))
-        self.comlist[0] = None
-        self.comlist[1] = None
-        self.comlist[2] = 1
-        self.comlist[3] = settings.INIT
+        # Communication between parent and child process happens via a shared
+        # memory ring holding the last packets and the status of the process
+        # (running normally, capturing or shutting down)
+        self.ring = SharedRing(slots)
         
-        multiprocessing.Process.__init__(self, target=self.runner, args=(self.comlist,))        
+        multiprocessing.Process.__init__(self, target=self.runner)
+
+        # set by ReceiverHub.add when the hub's process receives for us
+        self.hub = None
+
+        # Every wake-up all queued packets are read into these two buffers in
+        # turn, with coalesce only the newest of them is published
+        self.recv_buffers = [bytearray(65535), bytearray(65535)]
+        self.recv_views = [memoryview(b) for b in self.recv_buffers]
 
         self.PORT = port 
         self.INIT_PORT = port
@@ -99,63 +198,143 @@ class Receiver(multiprocessing.Process):
         # else:
         return 1
          
-    def runner(self, l):
+    def runner(self):
         print 'Starting receiver ', self.PORT, '\r'
         history = OrderedDict()
-        currentbuffer = 1       
         
         runs = 0
-        dumplist = []
+        capture = self.new_capture()
         time_start = datetime.datetime.now()
         init_val = self.init()
         # if not init_val:
         #     import sys
         #     sys.exit()
         self.set_status(settings.RUNNING)
-        while l[3] == settings.RUNNING or l[3] == settings.CAPTURE:
+        status = self.get_status()
+        last_init = 0
+        while status == settings.RUNNING or status == settings.CAPTURE:
             
             inputready, outputready, exceptready = select.select([self.sock], [], [], 1)
 
+            count = 0
             for i in inputready:
                 
                 if i == self.sock:
-                    try:
-                        data, addr = self.sock.recvfrom(65535)
-                    except socket.error, e:
-                        utils.dprint("",  e)
-            
-                    if data:
-                        utils.dprint("", 'Got data')
-                        if l[3] == settings.CAPTURE:
-                            dumplist.append((datetime.datetime.now(), data))
-                        l[2] = (runs+1)%2
-                        l[currentbuffer] = self.on_receive_data(data, history)
-                        currentbuffer = runs%2
-                        runs += 1
+                    count = self.receive_batch(status, history, capture)
+                    runs += count
             
-            if runs % 50 == 0:
+            # ask for more data every 50 packets, and while nothing comes
+            if runs - last_init >= 50 or not count:
                 self.init()
-
-
-        if len(dumplist):
-            ofile = open("./testdata/pickled_" + str(self.PORT) + ".data", "w")
-            pickle.dump(dumplist, ofile)
-            ofile.close()
+                last_init = runs
+            status = self.get_status()
+
+        self.shutdown(capture, runs, time_start)
+
+    # read at most this many packets per wake-up, so the status is still
+    # checked under a flood
+    RECV_BATCH = 64
+
+    # publish only the newest of the packets read in one wake-up, for
+    # receivers whose on_receive_data keeps no state from packet to packet
+    coalesce = False
+
+    def receive_batch(self, status, history, capture):
+        """Read the packets queued on the socket and publish them, in the
+        receiving process.
+
+        Packets are read with recvfrom_into into the preallocated buffers,
+        only published packets are copied out. Returns the number read.
+        """
+        count = coalesced = dropped = 0
+        newest = None
+        spare = 0
+        if status == settings.CAPTURE:
+            received = self.ring.get_counts()[0]
+        while count < self.RECV_BATCH:
+            try:
+                nbytes, addr = self.sock.recvfrom_into(self.recv_buffers[spare])
+            except socket.error, e:
+                if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
+                    utils.dprint("",  e)
+                    dropped += 1
+                break
+            count += 1
+            if status == settings.CAPTURE:
+                capture.write(self.PORT, received + count - 1, self.recv_views[spare][:nbytes])
+            if not self.coalesce:
+                dropped += self.publish(self.recv_views[spare][:nbytes], history)
+                continue
+            if newest is not None:
+                coalesced += 1
+            newest = (spare, nbytes)
+            spare = 1 - spare
+
+        if newest is not None:
+            dropped += self.publish(self.recv_views[newest[0]][:newest[1]], history)
+        if count or dropped:
+            self.ring.add_counts(count, coalesced, dropped)
+        return count
+
+    def publish(self, view, history):
+        """Publish a packet from the receive buffers, returns 1 if it was
+        dropped for not fitting the ring and 0 otherwise."""
+        try:
+            self.handle_data(view.tobytes(), history)
+        except ValueError, e:
+            utils.dprint("",  e)
+            return 1
+        return 0
+
+    def handle_data(self, data, history):
+        """Publish a received packet, in the receiving process."""
+        utils.dprint("", 'Got data')
+        self.ring.put(self.on_receive_data(data, history))
+
+    def get_receive_stats(self):
+        """Return the number of packets received, the number not published
+        because a newer one came in the same wake-up, and the number lost to
+        socket errors or too large to publish."""
+        return self.ring.get_counts()
+
+    def new_capture(self):
+        """Return the capture log packets are written to in CAPTURE mode, the
+        file is made on the first packet."""
+        return capturelog.CaptureWriter("./testdata/capture_" + str(self.PORT) + ".log")
+
+    def shutdown(self, capture, runs, time_start):
+        """Close the capture log, in the receiving process."""
+        captured = capture.close()
+        if captured:
+            print 'Captured', captured, 'packets to', capture.path, '\r'
 
         time_end = datetime.datetime.now()
         delta = (time_end - time_start)
         time_elapsed = (delta.microseconds + (delta.seconds*1000000.0))/1000000.0
         print 'Shutting down receiver ', self.PORT,'\t\t (' + str(runs), 'packets fetched in', time_elapsed, 'secs)\r'
-    
+
+    def start(self):
+        if self.hub is None:
+            multiprocessing.Process.start(self)
+        else:
+            self.set_status(settings.RUNNING)
+            self.hub.receiver_started(self)
+
     def stop(self):
-        self.comlist[3] = settings.STOPPING 
-        self.join()
+        self.set_status(settings.STOPPING)
+        if self.hub is None:
+            self.join()
+        else:
+            self.hub.receiver_stopped(self)
         self.sock.close()    
 
-    def get_data(self):
-        index = self.comlist[2]
-        data = self.comlist[index]
-        return self.on_request_data(data)
+    def get_data(self, *args):
+        # try again if the packet was overwritten while it was processed
+        while 1:
+            seq, data = self.ring.get_latest()
+            res = self.on_request_data(data, *args)
+            if seq < 0 or self.ring.is_valid(seq):
+                return res
     
     def record_sample(self):
         #print str(self.PORT), 'sample recorded at:', datetime.datetime.now(), "\r"
@@ -191,10 +370,10 @@ class Receiver(multiprocessing.Process):
             self.set_status(settings.CAPTURE)
     
     def get_status(self):
-        return self.comlist[3]
+        return self.ring.get_status()
 
     def set_status(self, arg):
-        self.comlist[3] = arg
+        self.ring.set_status(arg)
     
     def on_request_data(self, data):
         return data
@@ -209,17 +388,266 @@ class Receiver(multiprocessing.Process):
         return sample
     
 
+class ReceiverHub(multiprocessing.Process):
+    """One process receiving for several receivers.
+
+    The sockets of the receivers added to the hub are polled together with
+    epoll in the hub process, and every packet is handled by the receiver of
+    its socket just like in Receiver.runner. The receivers keep their own
+    shared rings, so get_data, get_status, record_sample and so on work as
+    usual, while there is one receiving process instead of one per receiver.
+
+    All receivers must be added before any is started. The hub process starts
+    when the last of them is started and stops when all are stopped.
+    """
+
+    def __init__(self):
+        multiprocessing.Process.__init__(self, target=self.runner)
+        self.receivers = []
+        self.started = []
+
+    def add(self, receiver):
+        assert not self.started, 'receivers must be added before the hub starts'
+        receiver.hub = self
+        self.receivers.append(receiver)
+
+    def receiver_started(self, receiver):
+        self.started.append(receiver)
+        if len(self.started) == len(self.receivers):
+            multiprocessing.Process.start(self)
+
+    def receiver_stopped(self, receiver):
+        if self.is_alive() and all(r.get_status() == settings.STOPPING for r in self.receivers):
+            self.join()
+
+    def runner(self):
+        print 'Starting receiver hub for ports', [r.PORT for r in self.receivers], '\r'
+        epoll = select.epoll()
+        # per socket: receiver, history, capture log, packets, packets at last
+        # init, time of last init
+        state = {}
+        time_start = datetime.datetime.now()
+        for r in self.receivers:
+            r.init()
+            epoll.register(r.sock.fileno(), select.EPOLLIN)
+            state[r.sock.fileno()] = [r, OrderedDict(), r.new_capture(), 0, 0, time.time()]
+
+        while state:
+            for fd, event in epoll.poll(1):
+                s = state.get(fd)
+                if s is None:
+                    continue
+                s[3] += s[0].receive_batch(s[0].get_status(), s[1], s[2])
+
+            now = time.time()
+            for fd, s in state.items():
+                r = s[0]
+                status = r.get_status()
+                if status != settings.RUNNING and status != settings.CAPTURE:
+                    epoll.unregister(fd)
+                    del state[fd]
+                    r.shutdown(s[2], s[3], time_start)
+                # ask for more data every 50 packets, and every second
+                elif s[3] - s[4] >= 50 or now - s[5] >= 1:
+                    r.init()
+                    s[4] = s[3]
+                    s[5] = now
+        epoll.close()
+        print 'Shutting down receiver hub\r'
+
+
+def _decode_worker(decode, inqueue, outqueue):
+    """Worker process for DecodePool, decodes (seq, packet) pairs until it
+    gets None."""
+    while 1:
+        item = inqueue.get()
+        if item is None:
+            break
+        seq, packet = item
+        try:
+            frame = decode(packet)[2]
+        except Exception, e:
+            print 'Decode worker failed on packet', seq, e, '\r'
+            frame = None
+        outqueue.put((seq, frame))
+
+
+class DecodePool(object):
+    """Decodes video packets in a number of worker processes.
+
+    Packets are numbered as they are submitted, the worker results are put
+    back in that order by a collector thread in the owning process, and kept
+    in a bounded queue where the oldest frame is dropped if nobody fetches
+    them. get_latest always has the newest frame in order.
+    """
+
+    def __init__(self, workers, maxsize=None, decode=decoder.read_picture_batched):
+        if maxsize is None:
+            maxsize = 2*workers
+        self.workers = workers
+        self.inqueue = multiprocessing.Queue(maxsize)
+        self.resultqueue = multiprocessing.Queue()
+        self.frames = deque()
+        self.maxsize = maxsize
+        self.cond = threading.Condition()
+        self.latest = None
+        self.next_submit = 0
+        self.submitted = 0
+        self.dropped_packets = 0
+        self.dropped_frames = 0
+        self.failed = 0
+        self.processes = [multiprocessing.Process(target=_decode_worker,
+                                                  args=(decode, self.inqueue, self.resultqueue))
+                          for i in xrange(workers)]
+        for p in self.processes:
+            p.daemon = True
+        self.collector = threading.Thread(target=self.collect)
+        self.collector.daemon = True
+
+    def start(self):
+        # build the tables before forking, so the workers inherit them
+        decoder.load_tables()
+        for p in self.processes:
+            p.start()
+        self.collector.start()
+
+    def submit(self, packet, block=False):
+        """Queue packet for decoding, returns its sequence number.
+
+        Returns None if the workers are behind and block is False, the packet
+        is dropped then.
+        """
+        try:
+            self.inqueue.put((self.next_submit, packet), block)
+        except Queue.Full:
+            self.dropped_packets += 1
+            return None
+        self.next_submit += 1
+        return self.next_submit - 1
+
+    def collect(self):
+        pending = {}
+        next_seq = 0
+        while 1:
+            item = self.resultqueue.get()
+            if item is None:
+                break
+            pending[item[0]] = item[1]
+            self.cond.acquire()
+            while next_seq in pending:
+                frame = pending.pop(next_seq)
+                if frame is None:
+                    self.failed += 1
+                else:
+                    if len(self.frames) >= self.maxsize:
+                        self.frames.popleft()
+                        self.dropped_frames += 1
+                    # every consumer gets this same frame
+                    frame.flags.writeable = False
+                    self.frames.append((next_seq, frame))
+                    self.latest = frame
+                next_seq += 1
+            if self.frames:
+                self.cond.notify_all()
+            self.cond.release()
+
+    def get(self, timeout=None):
+        """Return the next (seq, frame) in order, or None on timeout."""
+        self.cond.acquire()
+        if timeout is not None:
+            end = time.time() + timeout
+        while not self.frames:
+            if timeout is None:
+                self.cond.wait()
+            elif time.time() < end:
+                self.cond.wait(end - time.time())
+            else:
+                break
+        item = self.frames.popleft() if self.frames else None
+        self.cond.release()
+        return item
+
+    def get_latest(self):
+        return self.latest
+
+    def stop(self):
+        for p in self.processes:
+            self.inqueue.put(None)
+        for p in self.processes:
+            p.join()
+        self.resultqueue.put(None)
+        if self.collector.is_alive():
+            self.collector.join()
+
+
 class VideoReceiver(Receiver):
 
-    def __init__(self, port=settings.VIDEO_PORT):
+    # only the newest frame is ever shown
+    coalesce = True
+
+    def __init__(self, port=settings.VIDEO_PORT, decode_workers=0, frame_buffers=0):
         Receiver.__init__(self, port)
-               
+        # With decode workers, the receiver process hands every packet it
+        # publishes to the pool and get_data returns the newest decoded frame
+        self.decode_pool = None
+        if decode_workers:
+            self.decode_pool = DecodePool(decode_workers)
+
+        # The last decoded frame and the (frame number, size) of its packet,
+        # per (luma_only, roi) asked for. Callers between two packets all get
+        # this same array, so it is read only and must be copied before
+        # drawing on it.
+        self.frame_lock = threading.Lock()
+        self.frames = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # With frame_buffers, frames are decoded into that many reused arrays
+        # instead of a new one each time
+        self.frame_pool = None
+        if frame_buffers:
+            self.frame_pool = decoder.FramePool(frame_buffers)
+
+    def start(self):
+        if self.decode_pool is not None:
+            self.decode_pool.start()
+        Receiver.start(self)
+
     def stop(self):
         Receiver.stop(self)    
+        if self.decode_pool is not None:
+            self.decode_pool.stop()
+
+    def get_data(self, luma_only=False, roi=None, width=None):
+        """Return the newest frame, with luma_only as a single channel grey
+        image, which decodes faster than colour.
+
+        With roi, an (x, y, width, height) rectangle, only that part of the
+        picture is decoded. With width, pictures of another width give None.
+
+        With decode workers, colour frames come from the pool. Grey frames are
+        decoded from the luma alone here, as without workers, so they are the
+        same grey either way.
+        """
+        if self.decode_pool is not None and not luma_only:
+            frame = self.decode_pool.get_latest()
+            if frame is None or (width is not None and frame.shape[1] != width):
+                return None
+            # the pool decodes whole colour frames for all consumers
+            if roi is not None:
+                x, y, w, h = roi
+                frame = frame[y:y+h, x:x+w]
+            return frame
+        return Receiver.get_data(self, luma_only, roi, width)
+
+    def on_receive_data(self, data, history):
+        if self.decode_pool is not None:
+            self.decode_pool.submit(data)
+        return data
        
     def on_record_sample(self, data):
         
-        img = data
+        img = data.copy()
         saveimg = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         cv2.imwrite("../images/target-image-"+ str(time.time()) + ".png", saveimg)    
        
@@ -257,13 +685,39 @@ class VideoReceiver(Receiver):
             res = comparison[0,0]
             return res
 
-    def on_request_data(self, data):
+    def on_request_data(self, data, luma_only=False, roi=None, width=None):
         if data:
-            w, h, arr, ti = decoder.read_picture(data)
+            if width is not None and decoder.get_picture_size(data)[0] != width:
+                return None
+            key = (decoder.get_frame_number(data), len(data))
+            self.frame_lock.acquire()
+            try:
+                frame_key, arr = self.frames.get((luma_only, roi), (None, None))
+                if key == frame_key:
+                    self.cache_hits += 1
+                else:
+                    self.cache_misses += 1
+                    if self.frame_pool is not None:
+                        w, h, arr, ti = decoder.read_picture_into(data, self.frame_pool, luma_only, roi)
+                        # the pool decodes into its arrays again, only the view
+                        # handed out is read only
+                        arr = arr.view()
+                    else:
+                        w, h, arr, ti = decoder.read_picture_batched(data, luma_only, roi)
+                    arr.flags.writeable = False
+                    self.frames[(luma_only, roi)] = (key, arr)
+            finally:
+                # a bad packet raises in the caller only
+                self.frame_lock.release()
             return arr
         else:
             return None
 
+    def get_cache_stats(self):
+        """Return the number of get_data calls served from the last decoded
+        frame and the number that had to decode."""
+        return self.cache_hits, self.cache_misses
+
 class WifiReceiver(Receiver):
     
     def __init__(self, port):
@@ -373,16 +827,108 @@ class WifiReceiver(Receiver):
 class NavdataReceiver(Receiver):
 
 
-    def __init__(self, port=settings.NAVDATA_PORT):
+    def __init__(self, port=settings.NAVDATA_PORT, history_size=settings.NAVDATA_HISTORY):
         Receiver.__init__(self, port)
+        # the navdata of the last history_size packets, kept by the receiver
+        # process
+        self.history = None
+        if history_size:
+            self.history = NavdataHistory(history_size)
+
+    def get_history(self):
+        return self.history
+
+    def on_receive_data(self, data, history):
+        if self.history is not None:
+            try:
+                self.history.append(decoder.decode_navdata_lazy(data))
+            except struct.error, e:
+                # a short or broken packet is left out of the history, but
+                # must not take the receiving process down
+                utils.dprint("", e)
+        return data
         
     def on_request_data(self, data):
         if  data:
-            nd = decoder.decode_navdata(data)
+            # options are only decoded when looked up, with full navdata most
+            # of them never are
+            nd = decoder.decode_navdata_lazy(data)
             return nd
         else:
             return None
 
+class NavdataHistory(object):
+    """The last navdata packets as a numpy structured array.
+
+    The records are a ring of size entries in an anonymous shared mmap, so
+    like the SharedRing it must be created before forking, after which the
+    receiver process appends and the others query. Appending is O(1), queries
+    work on the whole window at once. A record is written before the count
+    that makes it visible, and a query drops the records that were
+    overwritten while it copied them, so no locks are needed.
+    """
+
+    DTYPE = np.dtype([('seq_nr', np.uint32), ('timestamp', np.float64),
+                      ('theta', np.float64), ('phi', np.float64), ('psi', np.float64),
+                      ('altitude', np.int32), ('vx', np.float64), ('vy', np.float64),
+                      ('vz', np.float64), ('battery', np.uint32)])
+    FIELDS = ('theta', 'phi', 'psi', 'altitude', 'vx', 'vy', 'vz', 'battery')
+    COUNT_SIZE = 8
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.mem = mmap.mmap(-1, self.COUNT_SIZE + size*self.DTYPE.itemsize)
+        # number of records ever appended
+        self.count = np.frombuffer(self.mem, dtype=np.int64, count=1)
+        self.records = np.frombuffer(self.mem, dtype=self.DTYPE, count=size, offset=self.COUNT_SIZE)
+
+    def append(self, navdata, timestamp=None):
+        """Add the demo values of a decoded navdata packet, packets without
+        them are skipped."""
+        demo = navdata.get(0) if navdata is not None else None
+        if not isinstance(demo, dict):
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        n = int(self.count[0])
+        self.records[n % self.size] = ((navdata['seq_nr'], timestamp) +
+                                       tuple([demo[f] for f in self.FIELDS]))
+        self.count[0] = n + 1
+
+    def __len__(self):
+        return int(min(self.count[0], self.size))
+
+    def last(self, n=None):
+        """Return a copy of the last n records (all if n is None), oldest
+        first. Once the ring is full its oldest record is left out, the writer
+        may be overwriting it."""
+        count = int(self.count[0])
+        n = min(count, self.size) if n is None else min(n, count, self.size)
+        res = self.records[np.arange(count - n, count) % self.size]
+        # drop what the writer overwrote while we copied, and the record it
+        # may be writing now, which the count does not show yet
+        overwritten = int(self.count[0]) - self.size - (count - n) + 1
+        if overwritten > 0:
+            res = res[overwritten:]
+        return res
+
+    def window(self, seconds, now=None):
+        """Return the records of the last seconds, oldest first."""
+        if now is None:
+            now = time.time()
+        res = self.last()
+        start = np.searchsorted(res['timestamp'], now - seconds)
+        return res[start:]
+
+    def mean(self, field, seconds, now=None):
+        """Mean of field over the last seconds, eg. mean('vx', 0.2), None if
+        there were no packets."""
+        values = self.window(seconds, now)[field]
+        if not len(values):
+            return None
+        return values.mean()
+
+
 class PeriodicTimer(threading.Thread):
     
 
@@ -24,6 +24,45 @@ DEBUG = False
 TEST = False#True
 MULTI = False
 
+# Number of processes decoding video for the VideoReceiver, with 0 frames are
+# decoded by whoever calls get_data
+DECODE_WORKERS = 0
+
+# Receive video, wifi and navdata in one process polling all three sockets,
+# instead of a process per receiver
+RECEIVER_HUB = False
+
+# Run the receivers, virtual sensors, task manager and AT command watchdog as
+# coroutines on one thread, with decoding and detection done by
+# EVENT_LOOP_WORKERS worker threads, instead of a thread or process each
+EVENT_LOOP = False
+EVENT_LOOP_WORKERS = 2
+
+# Ask the drone for all navdata options at 200Hz instead of the demo option
+# only at 15Hz
+NAVDATA_FULL = False
+
+# Number of navdata packets the NavdataReceiver keeps in its history, 15 per
+# second in demo mode and 200 with full navdata
+NAVDATA_HISTORY = 1024
+
+# The bottom camera inset of the combined video channels, as (x, y, width,
+# height) in the COMBO_WIDTH wide picture
+COMBO_WIDTH = 320
+COMBO_INSET = (0, 0, 88, 72)
+
+# The most bytes of AT commands sent in one datagram, the drone ignores the
+# rest of larger ones
+AT_PACKET_SIZE = 1024
+
+# Send the AT commands to TEST_DRONE_IP in test mode instead of dropping them,
+# for benchmarks listening there
+TEST_SEND_AT = False
+
+# How fast the TestDevice replays the recorded packets, 1 at the recorded
+# rate, N N times as fast and 0 as fast as they can be sent
+REPLAY_SPEED = 1.0
+
 # Constants
 STOPPED = 0
 STOPPING = 1
@@ -592,8 +592,7 @@ class SearchMarkTask(Task):
         to detect a homology between the two.
         """
         matching = None
-        frame_org = self.video_sensor.get_data()
-        frame = cv2.cvtColor(frame_org, cv.CV_RGB2GRAY)
+        frame = self.video_sensor.get_data(True)
         num = 0
        
         for m in self.mark:
@@ -22,67 +22,101 @@
 
 import os
 import socket
+import struct
 import time
+import math
+import bisect
+import heapq
 import threading
 import random
 import pickle
 
+import numpy as np
+
 import utils
 import decoder
 import settings
+import capturelog
+
+
+class PacketList(object):
+    """The packets of a capture pickled by older receivers, a list of
+    (datetime, data) held in memory."""
+
+    def __init__(self, packets):
+        self.packets = packets
+        self.timestamps = [time.mktime(t.timetuple()) + t.microsecond/1e6 for t, data in packets]
+
+    def __len__(self):
+        return len(self.packets)
+
+    def packet(self, i):
+        return self.packets[i][1]
+
+    def timestamp(self, i):
+        return self.timestamps[i]
+
+    def find(self, timestamp):
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+
+class FrameFiles(object):
+    """Video packets in the files ./testdata/N.dat, taken to be rate frames
+    per second. A file is read every time its packet is sent."""
+
+    def __init__(self, names, rate=15.0):
+        self.names = names
+        self.rate = rate
+
+    def __len__(self):
+        return len(self.names)
+
+    def packet(self, i):
+        f = open(self.names[i], 'r')
+        data = f.read()
+        f.close()
+        return data
+
+    def timestamp(self, i):
+        return i/self.rate
+
+    def find(self, timestamp):
+        return min(max(0, int(math.ceil(timestamp*self.rate))), len(self.names))
+
 
 class TestDevice(threading.Thread):
     
-    def __init__(self, runalone):
+    def __init__(self, runalone, speed=settings.REPLAY_SPEED):
         threading.Thread.__init__(self)
         self.run_alone = runalone
-        self.video_packets = []
-        self.wifi_packets = []
-        self.navdata_packets = []
         self.stopping = False
-        self.timeout = 10000
-        self.vi = 1
-        self.wi = 1
-        self.ni = 1
-        self.pickled_video = True
-        self.pickled_wifi = True
-        self.pickled_navdata = True
+        # seconds without an init packet before the device shuts down
+        self.timeout = 4000.0
+        self.speed = speed
 
         print 'Loading Test Data:\r'
         
-        # Determine whether we should use data from a pickled file or from the raw video packet files
-        if not os.path.isfile('./testdata/pickled_5555.data'):
-            self.pickled_video = False
-            while os.path.isfile('./testdata/' + str(self.vi) + '.dat'):
-                self.video_packets.append('./testdata/' + str(self.vi) + '.dat')
-                self.vi += 1
-            print "video frames:\t", self.vi
-        else:
-            fileObj = open('./testdata/pickled_5555.data')
-            self.video_packets = pickle.load(fileObj)
-            fileObj.close()
-            self.vi = len(self.video_packets)
-            print "video frames:\t", self.vi
+        # Use a capture log if there is one, else the pickled capture of older
+        # receivers, else the raw video packet files
+        self.video = self.load(settings.VIDEO_PORT)
+        if self.video is None:
+            names = []
+            while os.path.isfile('./testdata/' + str(len(names) + 1) + '.dat'):
+                names.append('./testdata/' + str(len(names) + 1) + '.dat')
+            self.video = FrameFiles(names)
+        print "video frames:\t", len(self.video)
 
-        # Determine whether we should use data from a pickled file or nothing at all
-        if not os.path.isfile('./testdata/pickled_5551.data'):
-            self.pickled_wifi = False
-        else:
-            fileObj = open('./testdata/pickled_5551.data')
-            self.wifi_packets = pickle.load(fileObj)
-            fileObj.close()
-            self.wi = len(self.wifi_packets)
-            print "Wifi frames:\t", self.wi
+        # Without data wifi samples are made up, without navdata none is sent
+        self.wifi = self.load(settings.WIFI_PORT)
+        if self.wifi is not None:
+            print "Wifi frames:\t", len(self.wifi)
 
-        # Determine whether we should use data from a pickled file or nothing at all
-        if not os.path.isfile('./testdata/pickled_5554.data'):
-            self.pickled_wifi = False
-        else:
-            fileObj = open('./testdata/pickled_5554.data')
-            self.navdata_packets = pickle.load(fileObj)
-            fileObj.close()
-            self.ni = len(self.navdata_packets)
-            print "Navdata frames:\t", self.ni
+        self.navdata = self.load(settings.NAVDATA_PORT)
+        if self.navdata is not None:
+            print "Navdata frames:\t", len(self.navdata)
+
+        # the number of the next packet sent from each source
+        self.positions = {settings.VIDEO_PORT: 0, settings.WIFI_PORT: 0, settings.NAVDATA_PORT: 0}
 
         print "********************************"
         # initialise the init and sending sockets
@@ -93,6 +127,37 @@ class TestDevice(threading.Thread):
         self.wifi_send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.navdata_send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
+    def load(self, port):
+        """Return the recorded packets of port, or None if there are none."""
+        path = './testdata/capture_' + str(port) + '.log'
+        if os.path.isfile(path):
+            return capturelog.CaptureLog(path, port)
+        path = './testdata/pickled_' + str(port) + '.data'
+        if os.path.isfile(path):
+            fileObj = open(path)
+            packets = pickle.load(fileObj)
+            fileObj.close()
+            return PacketList(packets)
+        return None
+
+    def get_sources(self):
+        """Return the (port, packets) of the recordings that are replayed."""
+        return [(port, source) for port, source in ((settings.VIDEO_PORT, self.video),
+                                                    (settings.WIFI_PORT, self.wifi),
+                                                    (settings.NAVDATA_PORT, self.navdata))
+                if source is not None and len(source)]
+
+    def seek(self, seconds=None, frame=None):
+        """Continue the replay from seconds after the start of the recording,
+        or from video frame number frame, with every port at the same point."""
+        sources = self.get_sources()
+        if frame is not None:
+            timestamp = self.video.timestamp(frame)
+        else:
+            timestamp = min(source.timestamp(0) for port, source in sources) + seconds
+        for port, source in sources:
+            self.positions[port] = source.find(timestamp) % len(source)
+
     def run(self):
         if not self.run_alone:
             print 'Starting TestDevice (waiting for incoming connection)\r'
@@ -102,66 +167,319 @@ class TestDevice(threading.Thread):
             utils.dprint("", 'received: ' + str(self.initpck))
         
         self.init_sock.setblocking(0)
-        
-        vi = 0
-        wi = 0
-        ni = 0
-        
-        while self.timeout and not self.stopping:
+
+        socks = {settings.VIDEO_PORT: self.video_send_sock,
+                 settings.WIFI_PORT: self.wifi_send_sock,
+                 settings.NAVDATA_PORT: self.navdata_send_sock}
+        self.sent = dict((port, 0) for port in socks)
+
+        # The next packet of every port, ordered by when it is due. Without
+        # a speed the ports take turns as fast as they can be sent.
+        sources = self.get_sources()
+        bases = self.get_bases(sources)
+        streams = [(port, self.schedule(port, source, bases[port])) for port, source in sources]
+        if self.wifi is None:
+            streams.append((settings.WIFI_PORT, self.made_up_wifi()))
+        queue = []
+        for port, stream in streams:
+            due, data = stream.next()
+            heapq.heappush(queue, (due if self.speed else 0, port, stream, data))
+
+        time_start = time.time()
+        last_init = time_start
+        while not self.stopping:
             data = 0
             try:
                 data, addr = self.init_sock.recvfrom(65535)
             except socket.error, e:
                 utils.dprint("",  e)
             
+            now = time.time()
             if data:
                 utils.dprint("", data)
                 utils.dprint("", 'TestDevice resetting shutdown timer')
-                self.timeout = 500
-            
-            # transmit video data
-            if self.pickled_video:
-                data = self.video_packets[vi][1]
-            else:
-                f = open(self.video_packets[vi % (self.vi-1)], 'r')
-                data = f.read()
-                f.close()
-                
-            self.video_send_sock.sendto(data, ('127.0.0.1', settings.VIDEO_PORT))
-            
-            # transmit WIFI data
-            if self.pickled_wifi:
-                wifidata = self.wifi_packets[wi][1]
-            else:
-                wifidata = "00:10:20:30:40:" + str(random.randint(10,30)) +" # " + str(random.randint(-75, 0))           
-            
-            self.wifi_send_sock.sendto(wifidata, ('127.0.0.1', settings.WIFI_PORT))
-            
-            # transmit navdata
-            if self.pickled_wifi:
-                navdata = self.navdata_packets[ni][1]
-                self.navdata_send_sock.sendto(navdata, ('127.0.0.1', settings.NAVDATA_PORT))
-           
-            vi += 1
-            if vi == self.vi:
-                vi = 0
-            
-            wi += 1
-            if wi == self.wi:
-                wi = 0
-            
-            ni += 1
-            if ni == self.ni:
-                ni = 0
+                self.timeout = 200.0
+                last_init = now
+            elif now - last_init > self.timeout:
+                break
 
-            self.timeout -= 1
-            time.sleep(0.4)
+            due, port, stream, data = queue[0]
+            if self.speed:
+                # sleep in short steps to notice init packets and stop
+                wait = time_start + due/self.speed - now
+                if wait > 0:
+                    time.sleep(min(wait, 0.1))
+                    continue
 
+            socks[port].sendto(data, ('127.0.0.1', port))
+            self.sent[port] += 1
+            due, data = stream.next()
+            heapq.heapreplace(queue, (due if self.speed else self.sent[port], port, stream, data))
+
+        elapsed = time.time() - time_start
+        for port, count in sorted(self.sent.items()):
+            print 'TestDevice sent', count, 'packets to', port, '(%.1f per sec)\r' % (count/max(elapsed, 1e-9))
         print 'Shutting down TestDevice\r'
 
+    def get_bases(self, sources):
+        """Return the time each port's replay starts from in its recording.
+
+        Recordings overlapping the one starting first were made together and
+        are replayed in step, others, like the N.dat files timed from 0, are
+        started along with it.
+        """
+        starts = dict((port, source.timestamp(self.positions[port])) for port, source in sources)
+        first = min(sources, key=lambda (port, source): starts[port])
+        end = first[1].timestamp(len(first[1]) - 1)
+        base = starts[first[0]]
+        return dict((port, base if starts[port] <= end else starts[port]) for port in starts)
+
+    def schedule(self, port, source, base):
+        """Yield the seconds after base each packet of source is due and the
+        packet, from its position on and over again after the last."""
+        n = len(source)
+        # the recording starts over one packet interval after its end
+        duration = source.timestamp(n - 1) - source.timestamp(0)
+        period = duration + (duration/(n - 1) if n > 1 else 0.4)
+        lap = 0.0
+        i = self.positions[port]
+        while 1:
+            self.positions[port] = (i + 1) % n
+            yield lap + source.timestamp(i) - base, source.packet(i)
+            i += 1
+            if i == n:
+                i = 0
+                lap += period
+
+    def made_up_wifi(self):
+        """Yield made up wifi samples every 0.4 seconds."""
+        i = 0
+        while 1:
+            yield i*0.4, "00:10:20:30:40:" + str(random.randint(10,30)) +" # " + str(random.randint(-75, 0))
+            i += 1
+
     def stop(self):
         self.stopping = True
        
+
+def make_navdata_packet(seq, full=False, rand=random):
+    """Return a navdata packet like the drone sends, with random values.
+
+    Demo packets have the demo option (id 0, 148 bytes) and the checksum
+    option. With full, the raw measures (2), altitude (10) and vision detect
+    (16) options and an option the decoder does not know are added.
+    """
+    state = rand.getrandbits(32)
+    packet = struct.pack('<IIII', 0x55667788, state, seq, 1)
+    demo = struct.pack('<IIfffIfffI', rand.randint(0, 0x50000), rand.randint(0, 100),
+                       rand.uniform(-30000, 30000), rand.uniform(-30000, 30000),
+                       rand.uniform(-180000, 180000), rand.randint(0, 3000),
+                       rand.uniform(-1000, 1000), rand.uniform(-1000, 1000),
+                       rand.uniform(-1000, 1000), seq)
+    options = [(0, demo + os.urandom(148 - 4 - len(demo)))]
+    if full:
+        options.append((2, struct.pack('<17H', *[rand.getrandbits(16) for i in xrange(17)]) + '\0\0'))
+        options.append((10, struct.pack('<ifiifffffIffI', *([rand.randint(0, 3000), 1.0, 2, 3] +
+                                                            [rand.random() for i in xrange(5)] +
+                                                            [4, 1.0, 2.0, 5]))))
+        options.append((16, struct.pack('<25If', *([rand.getrandbits(16) for i in xrange(25)] + [0.5]))))
+        options.append((99, os.urandom(12)))
+    for id_nr, payload in options:
+        packet += struct.pack('<HH', id_nr, len(payload) + 4) + payload
+    return packet + struct.pack('<HHI', 0xffff, 8, sum(map(ord, packet)) & 0xffffffff)
+
+
+class LoadGenerator(TestDevice):
+    """Sends video, navdata and wifi packets at set rates, with the jitter,
+    reordering, duplication and loss of a bad link, to find where the
+    receivers fall over.
+
+    rates is packets per second per port, video packets are the recorded
+    frames with video_pad bytes added and navdata packets are full navdata
+    with navdata_full. jitter delays each packet by up to that many seconds,
+    and reorder, duplicate and loss are the chances a packet is sent after
+    the next one, sent twice or not sent.
+
+    Every packet carries its number, at the end of video packets, as the
+    sequence number of navdata and as the signal strength of wifi samples,
+    so a LatencyProbe can tell which packet get_data shows.
+    """
+
+    TAG = struct.Struct('<q')
+
+    def __init__(self, rates=None, duration=10.0, video_pad=0, navdata_full=False, jitter=0.0,
+                 reorder=0.0, duplicate=0.0, loss=0.0, seed=None):
+        TestDevice.__init__(self, True)
+        self.rates = rates or {settings.VIDEO_PORT: 15.0, settings.NAVDATA_PORT: 200.0,
+                               settings.WIFI_PORT: 10.0}
+        self.duration = duration
+        self.video_pad = '\0'*video_pad
+        self.navdata_full = navdata_full
+        self.jitter = jitter
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.loss = loss
+        self.rand = random.Random(seed)
+
+        # per port: the time each packet number was first sent, and the
+        # packets made, lost, reordered, duplicated and sent
+        self.send_times = dict((port, {}) for port in self.rates)
+        self.counts = dict((port, dict(made=0, lost=0, reordered=0, duplicated=0, sent=0))
+                           for port in self.rates)
+
+    def make_packet(self, port, number):
+        if port == settings.VIDEO_PORT:
+            return str(self.video.packet(number % len(self.video))) + self.video_pad + self.TAG.pack(number)
+        elif port == settings.NAVDATA_PORT:
+            return make_navdata_packet(number, self.navdata_full, self.rand)
+        else:
+            return "00:10:20:30:40:" + str(10 + number % 8) + " # " + str(number)
+
+    @staticmethod
+    def get_tag(port, data):
+        """Return the number of the packet a receiver's published data is
+        from, or None."""
+        if port == settings.VIDEO_PORT:
+            return LoadGenerator.TAG.unpack_from(data, len(data) - LoadGenerator.TAG.size)[0]
+        elif port == settings.NAVDATA_PORT:
+            return struct.unpack_from('<I', data, 8)[0]
+        elif data:
+            # the wifi receiver publishes its history of samples per address
+            return max(sample[0] for sample in data.values())
+        return None
+
+    def run(self):
+        socks = {settings.VIDEO_PORT: self.video_send_sock,
+                 settings.WIFI_PORT: self.wifi_send_sock,
+                 settings.NAVDATA_PORT: self.navdata_send_sock}
+        # (time, order, port, number, data), data None for the time a packet
+        # is made and the packet for when it is sent
+        queue = [(0.0, i, port, 0, None) for i, port in enumerate(self.rates)]
+        order = len(queue)
+        time_start = time.time()
+        while queue and not self.stopping:
+            due, o, port, number, data = queue[0]
+            wait = time_start + due - time.time()
+            if wait > 0:
+                time.sleep(min(wait, 0.1))
+                continue
+            heapq.heappop(queue)
+
+            if data is not None:
+                socks[port].sendto(data, ('127.0.0.1', port))
+                self.send_times[port].setdefault(number, time.time())
+                self.counts[port]['sent'] += 1
+                continue
+
+            interval = 1.0/self.rates[port]
+            counts = self.counts[port]
+            counts['made'] += 1
+            if due + interval < self.duration:
+                heapq.heappush(queue, (due + interval, order, port, number + 1, None))
+                order += 1
+            if self.rand.random() < self.loss:
+                counts['lost'] += 1
+                continue
+            data = self.make_packet(port, number)
+            send = due + self.rand.uniform(0, self.jitter)
+            if self.rand.random() < self.reorder:
+                counts['reordered'] += 1
+                send += 1.5*interval
+            sends = [send]
+            if self.rand.random() < self.duplicate:
+                counts['duplicated'] += 1
+                sends.append(send + self.rand.uniform(0, interval))
+            for send in sends:
+                heapq.heappush(queue, (send, order, port, number, data))
+                order += 1
+
+        self.elapsed = time.time() - time_start
+
+
+class LatencyProbe(threading.Thread):
+    """Calls get_data on a receiver whenever it has a new packet, and times
+    each packet from when the LoadGenerator sent it until get_data returned
+    with it."""
+
+    def __init__(self, receiver, send_times):
+        threading.Thread.__init__(self)
+        self.receiver = receiver
+        self.send_times = send_times
+        self.stopping = False
+        self.seen = set()
+        self.latencies = []
+
+    def run(self):
+        last = -1
+        while not self.stopping:
+            seq, data = self.receiver.ring.get_latest()
+            if seq == last:
+                time.sleep(0.0002)
+                continue
+            last = seq
+            tag = LoadGenerator.get_tag(self.receiver.PORT, data)
+            self.receiver.get_data()
+            now = time.time()
+            if self.receiver.ring.is_valid(seq) and tag not in self.seen and tag in self.send_times:
+                self.seen.add(tag)
+                self.latencies.append(now - self.send_times[tag])
+
+    def stop(self):
+        self.stopping = True
+        self.join()
+
+
+def run_load(**options):
+    """Send a LoadGenerator's packets, made with options, to a video,
+    navdata and wifi receiver and print for each the packets lost on the way,
+    coalesced and shown by get_data, and the latency percentiles in ms.
+    Returns the rows printed."""
+    import receivers
+    settings.TEST = True
+    generator = LoadGenerator(**options)
+    sensors = [receivers.VideoReceiver(settings.VIDEO_PORT, settings.DECODE_WORKERS),
+               receivers.NavdataReceiver(settings.NAVDATA_PORT),
+               receivers.WifiReceiver(settings.WIFI_PORT)]
+    sensors = [r for r in sensors if r.PORT in generator.rates]
+    for r in sensors:
+        r.start()
+    probes = [LatencyProbe(r, generator.send_times[r.PORT]) for r in sensors]
+    for p in probes:
+        p.start()
+    time.sleep(0.2)
+    generator.start()
+    generator.join()
+    time.sleep(0.5)
+    for p in probes:
+        p.stop()
+
+    rows = []
+    print '%-16s %7s %6s %6s %8s %9s %7s %7s %7s %7s %7s' % (
+        'receiver', 'pkt/s', 'sent', 'lost', 'dropped', 'coalesced', 'shown',
+        'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    for r, p in zip(sensors, probes):
+        counts = generator.counts[r.PORT]
+        received, coalesced, dropped = r.get_receive_stats()
+        unique = counts['made'] - counts['lost']
+        latencies = np.array(p.latencies or [np.nan])*1000
+        row = dict(receiver=r.__class__.__name__, rate=counts['sent']/generator.elapsed,
+                   sent=counts['sent'], lost=counts['lost'],
+                   # packets that never got to the receiver, and lost to it
+                   dropped=1 - float(received)/max(counts['sent'], 1) + float(dropped)/max(counts['sent'], 1),
+                   coalesced=float(coalesced)/max(received, 1),
+                   shown=float(len(p.seen))/max(unique, 1),
+                   percentiles=np.percentile(latencies, [50, 90, 99, 100]))
+        rows.append(row)
+        print '%-16s %7.1f %6d %6d %7.1f%% %8.1f%% %6.1f%% %7.2f %7.2f %7.2f %7.2f' % ((
+            row['receiver'], row['rate'], row['sent'], row['lost'], 100*row['dropped'],
+            100*row['coalesced'], 100*row['shown']) + tuple(row['percentiles']))
+
+    for r in sensors:
+        r.stop()
+    generator.init_sock.close()
+    return rows
+
+
 if __name__ == '__main__':
     dev = TestDevice(True)
     dev.start()
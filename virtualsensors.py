@@ -9,6 +9,7 @@ import datetime
 import math
 import random
 import blobdetect as bd
+import eventloop
 from collections import OrderedDict
 
 class PositionDetector(object):
@@ -47,6 +48,11 @@ class PositionDetector(object):
         self.channel = alternate()
 
     def runner(self):
+        eventloop.run_blocking(self.detection())
+
+    def detection(self, loop=None):
+        """The detection loop as a coroutine, with a SensorLoop as loop the
+        frames are processed by its worker threads."""
 
         if self.show:
             win1 = cv2.namedWindow('win1')
@@ -54,115 +60,124 @@ class PositionDetector(object):
             win3 = cv2.namedWindow('win3')
 
         self.status = settings.RUNNING
-        frames = 0
-        pf = 0
-        sf = 0
+        self.frames = 0
+        self.pf = 0
+        self.sf = 0
         
         if self.mode == 'combo' or self.mode == 'combosimple':
             self.interface.zap(2)
-            time.sleep(2)
+            yield 2
         else:
             self.interface.zap(1)
-            time.sleep(2)
+            yield 2
 
         while not self.status == settings.STOPPING:
-            
-            if frames >= 199:
-                pass
-                #self.drone.stop()
-            frames += 1
-            #print 'frames: ',frames
+            if loop is None:
+                self.detect_once()
+            else:
+                yield loop.run_in_executor(self.detect_once)
+            yield self.loop_sleep
+        
+        # print self.frames
+        # print 'pointrate: ', self.pf/float(self.frames), '\r'
+        # print 'silrate: ', self.sf/float(self.frames), '\r'
+
+    def detect_once(self):
+        """Fetch the newest frame and look for positions in it."""
+        if self.frames >= 199:
+            pass
+            #self.drone.stop()
+        self.frames += 1
+        #print 'frames: ',self.frames
+        if self.mode == 'combo' or self.mode == 'combosimple':
+            # only the bottom camera inset is used, so only that is decoded
+            img = self.video_sensor.get_data(False, settings.COMBO_INSET, settings.COMBO_WIDTH)
+        else:
             img = self.video_sensor.get_data()
-                      
-            if img is None:
-                frames -= 1
-                print 'no images'
-                pass
-                       
-            elif self.mode == 'normal':
-                #self.interface.zap(self.channel.next())
-                if img.shape[1] == 176:
-                        self.last_small = img
-                        self.points = self.detect_position_img(img)
-                        if len(self.points) > 0:
-                            p = self.points[0]
-                        #for p in self.points:
-                            if self.show:
-                                cv2.circle(img, (int(p[0]), int(p[1])), 2, (255, 255, 255), 10)
-                               
-                            if p[2] == settings.GREEN:
-                                pf += 1
-                                print 'green'
-                            # elif p[2] == settings.BLUE:
-                            #     print 'blue\r'
+                  
+        if img is None:
+            self.frames -= 1
+            print 'no images'
+            pass
                    
-                elif img.shape[1] == 320:
-                    # minipic = img[0:88, 0:72]
-                    # self.points = self.detect_position_img(minipic)
-                    # if self.points is not None:
-                    #     pf += 1
-                    #     for p in self.points:
-                    #         print 'color: ', p[2]
-                    self.last_large = img
-                    self.silhouets = self.detect_silhouets(img)
-                    if len(self.silhouets) > 0:
-                        sf += 1
-                        print 'sil: ' , len(self.silhouets) , '\r'
-                   
-            elif self.mode == 'simple':
-                 blob = bd.detect_red_blob(img)
-                 if blob is not None:
-                     (xpos, ypos), (width, height) = position, size = blob
-                     if width*height > 15:
-                         pf += 1
-
-            elif self.mode == 'combo':
-                 if img.shape[1] == 320:
-                    minipic = img[0:72, 0:88]
-                    self.points = self.detect_position_img(minipic)
-                    if len(self.points) >= 1:
+        elif self.mode == 'normal':
+            #self.interface.zap(self.channel.next())
+            if img.shape[1] == 176:
+                    self.last_small = img
+                    self.points = self.detect_position_img(img)
+                    if len(self.points) > 0:
                         p = self.points[0]
+                    #for p in self.points:
+                        if self.show:
+                            # the frame is shared and read only, draw on a copy
+                            self.last_small = img = img.copy()
+                            cv2.circle(img, (int(p[0]), int(p[1])), 2, (255, 255, 255), 10)
+                           
                         if p[2] == settings.GREEN:
-                            pf += 1
-                            #print 'green'
-
-            elif self.mode == 'combosimple':
-                 if img.shape[1] == 320:
-                    minipic = img[0:88, 0:72]
-                    blob = bd.detect_red_blob(minipic)
-                    if blob is not None:
-                        (xpos, ypos), (width, height) = position, size = blob
-                        if width*height > 15:
-                            pf += 1
-
-            elif self.mode == 'wifi':
-                wifi_pos = self.detect_position_wifi()
-                if wifi_pos is not None:
-                    #print wifi_pos.name 
-                    if wifi_pos.name == 'pos3':
-                        pf += 1
-           
-            elif self.mode == 'test':
-                ran = random.randint(0, 50)
-                if ran in [48, 1, 4, 7, 22, 30]:
-                    color = random.randint(0, 4)
-                    img = img[0:176, 0:144]
-                    self.points = [(88.0, 72.0, color, img)]
-                    self.last_small = img
-                elif ran == 50:
-                    self.silhouets = [[88.0, 20, 200, 100]]
-                else:
-                    self.points = []
-                    self.silhouets = []
-
-            if self.show and img is not None:
-                cv2.imshow(win1 ,img)
+                            self.pf += 1
+                            print 'green'
+                        # elif p[2] == settings.BLUE:
+                        #     print 'blue\r'
+               
+            elif img.shape[1] == 320:
+                # minipic = img[0:88, 0:72]
+                # self.points = self.detect_position_img(minipic)
+                # if self.points is not None:
+                #     self.pf += 1
+                #     for p in self.points:
+                #         print 'color: ', p[2]
+                self.last_large = img
+                self.silhouets = self.detect_silhouets(img)
+                if len(self.silhouets) > 0:
+                    self.sf += 1
+                    print 'sil: ' , len(self.silhouets) , '\r'
+               
+        elif self.mode == 'simple':
+             blob = bd.detect_red_blob(img)
+             if blob is not None:
+                 (xpos, ypos), (width, height) = position, size = blob
+                 if width*height > 15:
+                     self.pf += 1
+
+        elif self.mode == 'combo':
+             minipic = img
+             self.points = self.detect_position_img(minipic)
+             if len(self.points) >= 1:
+                 p = self.points[0]
+                 if p[2] == settings.GREEN:
+                     self.pf += 1
+                     #print 'green'
+
+        elif self.mode == 'combosimple':
+             minipic = img
+             blob = bd.detect_red_blob(minipic)
+             if blob is not None:
+                 (xpos, ypos), (width, height) = position, size = blob
+                 if width*height > 15:
+                     self.pf += 1
+
+        elif self.mode == 'wifi':
+            wifi_pos = self.detect_position_wifi()
+            if wifi_pos is not None:
+                #print wifi_pos.name 
+                if wifi_pos.name == 'pos3':
+                    self.pf += 1
+       
+        elif self.mode == 'test':
+            ran = random.randint(0, 50)
+            if ran in [48, 1, 4, 7, 22, 30]:
+                color = random.randint(0, 4)
+                img = img[0:176, 0:144]
+                self.points = [(88.0, 72.0, color, img)]
+                self.last_small = img
+            elif ran == 50:
+                self.silhouets = [[88.0, 20, 200, 100]]
+            else:
+                self.points = []
+                self.silhouets = []
 
-            time.sleep(self.loop_sleep)
-        
-        # print frames
-        # print 'pointrate: ', pf/float(frames), '\r'
-        # print 'silrate: ', sf/float(frames), '\r'
+        if self.show and img is not None:
+            cv2.imshow('win1', img)
 
     def get_status(self):
         return self.status
@@ -171,7 +186,8 @@ class PositionDetector(object):
         self.status = arg
 
     def start(self):
-        threading.Thread(target=self.runner).start() 
+        loop = self.drone.get_event_loop()
+        eventloop.spawn(loop, self.detection(loop))
     
     def stop(self):
         self.status = settings.STOPPING
@@ -179,7 +195,8 @@ class PositionDetector(object):
 
     def detect_position_img(self, img):
         result = []
-        org = img
+        # copy, the boxes are drawn on it and the frame is shared
+        org = img.copy()
         pic = cv2.cvtColor(org, cv2.COLOR_BGR2RGB)
         hsv = cv2.cvtColor(org, cv2.COLOR_RGB2HSV)
         thresh_l = cv2.inRange(hsv, np.asarray((0, 30, 30)), np.asarray((30, 150, 255)))
@@ -387,11 +404,15 @@ class DistanceTracker(object):
         self.loop_sleep = 0.03
 
     def runner(self):
+        eventloop.run_blocking(self.tracking())
+
+    def tracking(self):
+        """ The measuring loop as a coroutine """
         self.last_time = time.time()
         self.status = settings.RUNNING
         while not self.status == settings.STOPPING:
              self.measure()
-             time.sleep(self.loop_sleep)
+             yield self.loop_sleep
         print 'moved: (', self.dist_x, ', ', self.dist_y, ')'
 
     def measure(self):
@@ -454,7 +475,7 @@ class DistanceTracker(object):
         self.status = arg
 
     def start(self):
-        threading.Thread(target=self.runner).start() 
+        eventloop.spawn(self.drone.get_event_loop(), self.tracking())
     
     def stop(self):
         self.status = settings.STOPPING